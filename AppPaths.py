@@ -0,0 +1,21 @@
+import os
+
+class AppPaths:
+    # Environment variable that overrides the default data directory
+    _home_env = "IMAGELABELIA_HOME"
+
+    @staticmethod
+    def data_dir(*parts):
+        """
+        Return a path inside the application data directory, creating it if needed.
+
+        Args:
+        - parts (str): Optional sub-directories appended to the data directory.
+
+        Returns:
+        - str: The absolute path of the requested directory.
+        """
+        base_dir = os.environ.get(AppPaths._home_env) or os.path.join(os.path.expanduser("~"), ".imagelabelia")
+        path = os.path.join(base_dir, *parts)
+        os.makedirs(path, exist_ok=True)
+        return path
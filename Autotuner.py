@@ -0,0 +1,245 @@
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import socket
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from AppPaths import AppPaths
+
+class TuningProfile:
+    """
+    Inference settings of one model on one host.
+
+    Profiles are written by the autotuner to profiles.json in the application
+    data folder, keyed by host name and model id, and loaded by the models at
+    startup. Settings left to None keep the PyTorch defaults.
+    """
+    _file_name = "profiles.json"
+    # set_num_interop_threads can only be called once per process
+    _inter_op_applied = False
+
+    def __init__(self, batch_size=1, intra_op_threads=None, inter_op_threads=None, decode_workers=1):
+        self.batch_size = batch_size
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.decode_workers = decode_workers
+
+    def to_dict(self):
+        return {
+            "batch_size": self.batch_size,
+            "intra_op_threads": self.intra_op_threads,
+            "inter_op_threads": self.inter_op_threads,
+            "decode_workers": self.decode_workers,
+        }
+
+    @classmethod
+    def _read_all(cls):
+        try:
+            with open(os.path.join(AppPaths.data_dir(), cls._file_name), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    @classmethod
+    def load(cls, model_id, host=None):
+        """Load the profile of a model on this host, or the defaults if it was never tuned."""
+        profile = cls._read_all().get(host or socket.gethostname(), {}).get(model_id)
+        return cls(**profile) if profile else cls()
+
+    def save(self, model_id, host=None):
+        """Store the profile of a model on this host."""
+        profiles = self._read_all()
+        profiles.setdefault(host or socket.gethostname(), {})[model_id] = self.to_dict()
+
+        path = os.path.join(AppPaths.data_dir(), self._file_name)
+        with open(path + ".tmp", 'w') as f:
+            json.dump(profiles, f, indent=4)
+        os.replace(path + ".tmp", path)
+
+    def apply(self):
+        """Apply the thread settings to the current process."""
+        if self.intra_op_threads and torch.get_num_threads() != self.intra_op_threads:
+            torch.set_num_threads(self.intra_op_threads)
+        if self.inter_op_threads and not TuningProfile._inter_op_applied:
+            TuningProfile._inter_op_applied = True
+            try:
+                torch.set_num_interop_threads(self.inter_op_threads)
+            except RuntimeError:
+                # Inter-op work already started in this process, keep the current pool
+                pass
+
+
+def _throughput(run, batch_size, min_time):
+    """Measure images per second of a batch function after one warm-up call."""
+    run()
+    count = 0
+    start = time.perf_counter()
+    while True:
+        run()
+        count += batch_size
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time and count >= 2 * batch_size:
+            return count / elapsed
+
+
+def _synthetic_inputs(model, batch_size):
+    """Random model inputs with the shapes produced by the model's processor."""
+    size = model.processor.size
+    if "shortest_edge" in size:
+        # DETR: shortest edge resize of a 4:3 photo, with its pixel mask
+        height, width = size["shortest_edge"], size["shortest_edge"] * 4 // 3
+        return {
+            "pixel_values": torch.randn(batch_size, 3, height, width),
+            "pixel_mask": torch.ones(batch_size, height, width, dtype=torch.long),
+        }
+    return {"pixel_values": torch.randn(batch_size, 3, size["height"], size["width"])}
+
+
+def _synthetic_images(directory, count):
+    """Write JPEG files the size of a typical camera frame for the decode sweep."""
+    from PIL import Image
+
+    image = Image.radial_gradient("L").resize((4000, 3000)).convert("RGB")
+    paths = []
+    for idx in range(count):
+        path = os.path.join(directory, f"synthetic_{idx}.jpg")
+        image.save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def _calibrate(model_name, inter_op_threads, options, results):
+    """
+    Sweep batch sizes, intra-op threads and decode workers in a fresh process.
+
+    Inter-op threads can only be set before any parallel work, so every
+    inter-op setting runs in its own process and reports through a queue.
+    """
+    torch.set_num_interop_threads(inter_op_threads)
+
+    from ImageUtils import ImageUtils
+    if model_name == "classifier":
+        from ImageClasifier import ImageClassifier
+        model = ImageClassifier(profile=TuningProfile())
+    else:
+        from ImageDetector import ObjectDetector
+        model = ObjectDetector(profile=TuningProfile())
+
+    best = None
+    for intra_op_threads in options["intra_op_threads"]:
+        torch.set_num_threads(intra_op_threads)
+        for batch_size in options["batch_sizes"]:
+            inputs = _synthetic_inputs(model, batch_size)
+            throughput = _throughput(lambda: model._run_model(inputs), batch_size, options["min_time"])
+            print(f"{model_name}: inter-op {inter_op_threads}, intra-op {intra_op_threads}, batch {batch_size}: {throughput:.1f} images/s")
+            if best is None or throughput > best["throughput"]:
+                best = {"throughput": throughput, "batch_size": batch_size, "intra_op_threads": intra_op_threads}
+
+    if options["decode"]:
+        # Decoding plus preprocessing, the CPU work that runs beside inference
+        torch.set_num_threads(best["intra_op_threads"])
+        with tempfile.TemporaryDirectory() as directory:
+            paths = _synthetic_images(directory, max(options["decode_workers"]) * 2)
+            decode = lambda path: model.processor(images=[ImageUtils.load_image(path)], return_tensors="pt")
+            for decode_workers in options["decode_workers"]:
+                with ThreadPoolExecutor(decode_workers) as pool:
+                    throughput = _throughput(lambda: list(pool.map(decode, paths)), len(paths), options["min_time"])
+                print(f"{model_name}: {decode_workers} decode workers: {throughput:.1f} images/s")
+                if "decode_throughput" not in best or throughput > best["decode_throughput"]:
+                    best["decode_throughput"] = throughput
+                    best["decode_workers"] = decode_workers
+
+    results.put(best)
+
+
+class Autotuner:
+    """Run calibration sweeps and store the best TuningProfile of each model for this host."""
+
+    def __init__(self, batch_sizes=(1, 2, 4, 8), min_time=1.0):
+        cpu_count = os.cpu_count() or 1
+        powers = [2 ** exponent for exponent in range(cpu_count.bit_length()) if 2 ** exponent <= cpu_count]
+        self.options = {
+            "batch_sizes": list(batch_sizes),
+            "intra_op_threads": sorted(set(powers + [cpu_count])),
+            "decode_workers": sorted(set(powers[:4] + [max(1, cpu_count // 2)])),
+            "min_time": min_time,
+        }
+        self.inter_op_threads = [threads for threads in (1, 2, 4) if threads <= cpu_count]
+
+    @staticmethod
+    def _wait_result(process, results, poll_interval=1):
+        """Wait for a calibration process's result, returning None if it exits without one."""
+        while True:
+            try:
+                return results.get(timeout=poll_interval)
+            except queue.Empty:
+                if process.is_alive():
+                    continue
+            # The process exited, a result it put just before is still readable
+            try:
+                return results.get(timeout=poll_interval)
+            except queue.Empty:
+                return None
+
+    def tune(self, model_name, model_id):
+        """
+        Find and save the fastest settings of a model.
+
+        Args:
+        - model_name (str): "classifier" or "detector".
+        - model_id (str): Hub id the profile is stored under.
+
+        Returns:
+        - The saved TuningProfile.
+        """
+        context = multiprocessing.get_context("spawn")
+        best = None
+        for idx, inter_op_threads in enumerate(self.inter_op_threads):
+            results = context.Queue()
+            # Decode throughput doesn't depend on inter-op threads, sweep it only once
+            options = dict(self.options, decode=idx == 0)
+            process = context.Process(target=_calibrate, args=(model_name, inter_op_threads, options, results))
+            process.start()
+            result = self._wait_result(process, results)
+            process.join()
+            if result is None:
+                raise RuntimeError(f"Calibration of the {model_name} with {inter_op_threads} inter-op threads failed (exit code {process.exitcode})")
+
+            result["inter_op_threads"] = inter_op_threads
+            if best is None:
+                best = result
+            elif result["throughput"] > best["throughput"]:
+                result["decode_workers"] = best["decode_workers"]
+                best = result
+
+        profile = TuningProfile(best["batch_size"], best["intra_op_threads"], best["inter_op_threads"], best["decode_workers"])
+        profile.save(model_id)
+        return profile
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calibrate batch size and thread counts of the models on this machine.")
+    parser.add_argument("--models", nargs="+", choices=["classifier", "detector"], default=["classifier", "detector"], help="Models to tune.")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 2, 4, 8], help="Batch sizes to try.")
+    parser.add_argument("--min-time", type=float, default=1.0, help="Seconds measured per setting.")
+    args = parser.parse_args()
+
+    from ImageClasifier import ImageClassifier
+    from ImageDetector import ObjectDetector
+    model_ids = {"classifier": ImageClassifier.model_id, "detector": ObjectDetector.model_id}
+
+    autotuner = Autotuner(args.batch_sizes, args.min_time)
+    for model_name in args.models:
+        try:
+            profile = autotuner.tune(model_name, model_ids[model_name])
+        except RuntimeError as e:
+            # The calibration process printed its traceback, keep tuning the other models
+            print(f"ERROR: {e}")
+            continue
+        print(f"{model_name}: saved {profile.to_dict()}")
@@ -0,0 +1,193 @@
+import json
+import os
+import threading
+
+import numpy as np
+import torch
+
+class EmbeddingStore:
+    """
+    Store of image embeddings kept in a memory-mapped float16 matrix.
+
+    The matrix file holds one L2-normalized row per image and a JSON-lines
+    sidecar holds the path of each row, so cosine similarity is a plain dot
+    product. New paths are appended and re-embedded paths overwrite their
+    row in place. Searches stream the matrix in chunks from the memory map,
+    which keeps large libraries out of process memory.
+    """
+    _matrix_name = "embeddings.f16"
+    _paths_name = "paths.jsonl"
+    _meta_name = "meta.json"
+    _dtype = np.float16
+
+    def __init__(self, directory, search_chunk_rows=32768):
+        self.directory = directory
+        self.search_chunk_rows = search_chunk_rows
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self.dim = self._read_dim()
+        self._paths = self._read_paths()
+        self._rows = {path: row for row, path in enumerate(self._paths)}
+        self._repair()
+
+    def __len__(self):
+        return len(self._paths)
+
+    def _file(self, name):
+        return os.path.join(self.directory, name)
+
+    def _read_dim(self):
+        """Read the embedding dimension from the metadata file, if any."""
+        try:
+            with open(self._file(self._meta_name), 'r') as f:
+                return json.load(f)["dim"]
+        except FileNotFoundError:
+            return None
+
+    def _write_dim(self, dim):
+        with open(self._file(self._meta_name), 'w') as f:
+            json.dump({"dim": dim, "dtype": np.dtype(self._dtype).name}, f)
+        self.dim = dim
+
+    def _read_paths(self):
+        """Read the path sidecar, one JSON encoded path per line."""
+        paths = []
+        try:
+            with open(self._file(self._paths_name), 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        paths.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        # A torn last line from an interrupted append
+                        break
+        except FileNotFoundError:
+            pass
+        return paths
+
+    def _repair(self):
+        """Bring the matrix and the sidecar back to the same number of rows after an interrupted append."""
+        if self.dim is None:
+            return
+        row_bytes = self.dim * np.dtype(self._dtype).itemsize
+        matrix_path = self._file(self._matrix_name)
+        disk_rows = os.path.getsize(matrix_path) // row_bytes if os.path.exists(matrix_path) else 0
+
+        if disk_rows > len(self._paths) or (os.path.exists(matrix_path) and os.path.getsize(matrix_path) % row_bytes):
+            with open(matrix_path, 'r+b') as f:
+                f.truncate(min(disk_rows, len(self._paths)) * row_bytes)
+        if len(self._paths) > disk_rows:
+            self._paths = self._paths[:disk_rows]
+            self._rows = {path: row for row, path in enumerate(self._paths)}
+            with open(self._file(self._paths_name), 'w', encoding='utf-8') as f:
+                for path in self._paths:
+                    f.write(json.dumps(path) + "\n")
+
+    def _matrix(self):
+        """Return a copy-on-write memory map over the stored rows, or None if empty."""
+        if not self._paths:
+            return None
+        return np.memmap(self._file(self._matrix_name), dtype=self._dtype, mode='c', shape=(len(self._paths), self.dim))
+
+    @staticmethod
+    def _normalize(embeddings):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+        return embeddings / np.maximum(norms, 1e-12)
+
+    def add(self, paths, embeddings):
+        """
+        Store embeddings for the given image paths, replacing the ones stored before.
+
+        Args:
+        - paths (list of str): Paths of the embedded images.
+        - embeddings (array-like): Matrix with one embedding per path.
+        """
+        embeddings = np.atleast_2d(self._normalize(embeddings)).astype(self._dtype)
+        if len(paths) != embeddings.shape[0]:
+            raise ValueError(f"Got {len(paths)} paths for {embeddings.shape[0]} embeddings")
+
+        with self._lock:
+            if self.dim is None:
+                self._write_dim(embeddings.shape[1])
+            elif embeddings.shape[1] != self.dim:
+                raise ValueError(f"Expected embeddings of size {self.dim}, got {embeddings.shape[1]}")
+
+            # Paths stored before keep their row, so reprocessing a library doesn't grow the matrix
+            updated = {}
+            appended = {}
+            for path, embedding in zip(paths, embeddings):
+                if path in self._rows:
+                    updated[self._rows[path]] = embedding
+                else:
+                    appended[path] = embedding
+
+            if appended:
+                # Rows go first so an interrupted append leaves extra rows that _repair drops
+                with open(self._file(self._matrix_name), 'ab') as f:
+                    f.write(np.stack(list(appended.values())).tobytes())
+                with open(self._file(self._paths_name), 'a', encoding='utf-8') as f:
+                    for path in appended:
+                        f.write(json.dumps(path) + "\n")
+
+                for path in appended:
+                    self._rows[path] = len(self._paths)
+                    self._paths.append(path)
+
+            if updated:
+                row_bytes = self.dim * np.dtype(self._dtype).itemsize
+                with open(self._file(self._matrix_name), 'r+b') as f:
+                    for row, embedding in sorted(updated.items()):
+                        f.seek(row * row_bytes)
+                        f.write(embedding.tobytes())
+
+    def get(self, path):
+        """Return the stored embedding for a path, or None if it was never stored."""
+        row = self._rows.get(path)
+        if row is None:
+            return None
+        return np.array(self._matrix()[row], dtype=np.float32)
+
+    def search(self, query, k=10, exclude_path=None):
+        """
+        Find the stored images most similar to a query embedding.
+
+        Args:
+        - query (array-like): The query embedding.
+        - k (int): Number of results to return.
+        - exclude_path (str): Optional path left out of the results (usually the query image).
+
+        Returns:
+        - List of (path, cosine similarity) tuples, best match first.
+        """
+        matrix = self._matrix()
+        if matrix is None:
+            return []
+
+        query = torch.from_numpy(self._normalize(query).reshape(-1))
+        # One extra candidate makes up for the excluded path
+        fetch = min(k + 1, len(self._paths))
+        best_scores = torch.empty(0)
+        best_rows = torch.empty(0, dtype=torch.long)
+
+        with torch.no_grad():
+            for start in range(0, matrix.shape[0], self.search_chunk_rows):
+                block = torch.from_numpy(np.asarray(matrix[start:start + self.search_chunk_rows])).float()
+                scores = block @ query
+                top_scores, top_rows = torch.topk(scores, min(fetch, scores.numel()))
+                best_scores = torch.cat([best_scores, top_scores])
+                best_rows = torch.cat([best_rows, top_rows + start])
+                if best_scores.numel() > fetch:
+                    best_scores, keep = torch.topk(best_scores, fetch)
+                    best_rows = best_rows[keep]
+
+        order = torch.argsort(best_scores, descending=True)
+        results = []
+        for idx in order.tolist():
+            path = self._paths[best_rows[idx].item()]
+            if path == exclude_path:
+                continue
+            results.append((path, best_scores[idx].item()))
+            if len(results) == k:
+                break
+        return results
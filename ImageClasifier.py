@@ -3,45 +3,134 @@ import torch.nn.functional as F
 import torch
 
 from ImageUtils import ImageUtils
+from MemoryBudget import MemoryBudget
+from ModelRegistry import ModelRegistry
+from Autotuner import TuningProfile
 
 class ImageClassifier:
-    def __init__(self):
+    model_id = 'google/vit-base-patch16-224'
+
+    def __init__(self, embedding_store=None, memory_budget=None, registry=None, dtype=None, warmup=False, profile=None):
         # Define the device (use CUDA if available, otherwise use CPU)
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-        # Load the pretrained Vision Transformer (ViT) image processor and model
-        self.processor = ViTImageProcessor.from_pretrained('google/vit-base-patch16-224')
-        self.model = ViTForImageClassification.from_pretrained('google/vit-base-patch16-224').to(self.device)
+        # Load the pretrained Vision Transformer (ViT) image processor and model from the local registry
+        registry = registry if registry is not None else ModelRegistry()
+        self.processor, self.model = registry.load(ViTForImageClassification, ViTImageProcessor, self.model_id, dtype=dtype)
+        self.model = self.model.to(self.device)
 
-    def classify(self, image_path):
+        # Optional EmbeddingStore where the pooled embedding of every classified image is appended
+        self.embedding_store = embedding_store
+
+        # Shared MemoryBudget limiting the decoded pixels in flight (unlimited by default)
+        self.memory_budget = memory_budget if memory_budget is not None else MemoryBudget(budget_bytes=None)
+
+        # Batch size and thread settings tuned for this host (see Autotuner.py)
+        self.profile = profile if profile is not None else TuningProfile.load(self.model_id)
+        self.profile.apply()
+
+        if warmup:
+            self.warm_up()
+
+    def warm_up(self):
+        """Run one forward pass on a blank input so the first real image doesn't pay for lazy initialisation."""
+        size = self.processor.size
+        self._run_model({"pixel_values": torch.zeros(1, 3, size["height"], size["width"])})
+
+    def _run_model(self, inputs):
         """
-        Classify an image using the pretrained Vision Transformer (ViT) model.
+        Run the Vision Transformer (ViT) on preprocessed inputs.
 
         Args:
-        - image_path (str): Path to the image to be classified.
+        - inputs (dict): Tensors returned by the image processor.
 
         Returns:
-        - List of predicted classes for the image.
+        - Tuple (logits, embeddings) of tensors.
+        """
+        # Both models share the process, so the thread settings of this one are applied before every run
+        self.profile.apply()
+
+        # Move the inputs to the model's device, matching its (possibly reduced) precision
+        inputs = {key: val.to(self.device, self.model.dtype) if val.is_floating_point() else val.to(self.device) for key, val in inputs.items()}
+
+        with torch.no_grad():
+            # The classification head reads the [CLS] token of the final hidden state,
+            # so that token is the pooled embedding
+            sequence_output = self.model.vit(**inputs)[0]
+            embeddings = sequence_output[:, 0, :]
+            logits = self.model.classifier(embeddings)
+        return logits, embeddings
+
+    def predict_images(self, images, inputs=None):
         """
+        Classify a batch of loaded images with a single Vision Transformer (ViT) forward pass.
 
-        image = ImageUtils.load_image(image_path)
+        Args:
+        - images (list of PIL.Image): The images to classify.
+        - inputs (dict): Optional inputs already preprocessed for the batch (see BatchPreprocessor.py).
 
-        # Preprocess the image and convert to tensor format suitable for the model
-        inputs = self.processor(images=[image], return_tensors="pt")
-        inputs = {key: val.to(self.device) for key, val in inputs.items()}
+        Returns:
+        - List of (predicted classes, probability, embedding) tuples, one per image.
+        """
+        # Preprocess the images and convert to tensor format suitable for the model
+        if inputs is None:
+            inputs = self.processor(images=images, return_tensors="pt")
+        logits, embeddings = self._run_model(inputs)
 
-        # Predict the class of the image using the Vision Transformer (ViT)
-        outputs = self.model(**inputs)
-        logits = outputs.logits
-        
         # Convert logits to probabilities
-        probabilities = F.softmax(logits, dim=1)
+        probabilities = F.softmax(logits.float(), dim=1)
 
-        # Get the predicted class index
-        predicted_class_idx = torch.argmax(probabilities, dim=1).item()
+        # Get the predicted class index of every image and its probability
+        scores, predicted_class_idxs = torch.max(probabilities, dim=1)
 
-        # Return the label of the predicted class
+        embeddings = embeddings.float().cpu().numpy()
+        return [
+            (self._labels(idx), score, embedding)
+            for idx, score, embedding in zip(predicted_class_idxs.tolist(), scores.tolist(), embeddings)
+        ]
+
+    def _labels(self, predicted_class_idx):
+        """Return the label of the predicted class split into its synonyms."""
         classes_detected = []
         if self.model.config.id2label[predicted_class_idx]:
             classes_detected= self.model.config.id2label[predicted_class_idx].split(", ")
         return classes_detected
+
+    def embed(self, image_path):
+        """
+        Compute the pooled ViT embedding of an image.
+
+        Args:
+        - image_path (str): Path to the image.
+
+        Returns:
+        - numpy.ndarray with the embedding of the image.
+        """
+        with self.memory_budget.reserve(image_path) as max_pixels:
+            image = ImageUtils.load_image(image_path, max_pixels=max_pixels)
+            [(_, _, embedding)] = self.predict_images([image])
+        return embedding
+
+    def classify(self, image_path):
+        """
+        Classify an image using the pretrained Vision Transformer (ViT) model.
+
+        Args:
+        - image_path (str): Path to the image to be classified.
+
+        Returns:
+        - List of predicted classes for the image.
+        """
+
+        with self.memory_budget.reserve(image_path) as max_pixels:
+            image = ImageUtils.load_image(image_path, max_pixels=max_pixels)
+
+            # Predict the class of the image using the Vision Transformer (ViT)
+            [(classes_detected, _, embedding)] = self.predict_images([image])
+            del image
+
+        if self.embedding_store is not None:
+            self.embedding_store.add([image_path], embedding[None, :])
+
+        # Return the label of the predicted class
+        return classes_detected
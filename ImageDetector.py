@@ -2,15 +2,92 @@
 from transformers import DetrImageProcessor, DetrForObjectDetection
 import torch
 from ImageUtils import ImageUtils
+from MemoryBudget import MemoryBudget
+from ModelRegistry import ModelRegistry
+from Autotuner import TuningProfile
+from BatchPreprocessor import FusedPreprocessor
 
 class ObjectDetector:
-    def __init__(self):
+    model_id = "facebook/detr-resnet-50"
+
+    def __init__(self, memory_budget=None, registry=None, dtype=None, warmup=False, profile=None):
         # Define the device (use CUDA if available, otherwise use CPU)
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-        # Load pretrained DETR image processor and model from Huggingface's transformers library
-        self.processor = DetrImageProcessor.from_pretrained("facebook/detr-resnet-50")
-        self.model = DetrForObjectDetection.from_pretrained("facebook/detr-resnet-50").to(self.device)
+        # Load pretrained DETR image processor and model from the local registry
+        registry = registry if registry is not None else ModelRegistry()
+        self.processor, self.model = registry.load(DetrForObjectDetection, DetrImageProcessor, self.model_id, dtype=dtype)
+        self.model = self.model.to(self.device)
+
+        # Shared MemoryBudget limiting the decoded pixels in flight (unlimited by default)
+        self.memory_budget = memory_budget if memory_budget is not None else MemoryBudget(budget_bytes=None)
+
+        # Batch size and thread settings tuned for this host (see Autotuner.py)
+        self.profile = profile if profile is not None else TuningProfile.load(self.model_id)
+        self.profile.apply()
+
+        if warmup:
+            self.warm_up()
+
+    def warm_up(self):
+        """Run one forward pass on a blank input so the first real image doesn't pay for lazy initialisation."""
+        edge = self.processor.size["shortest_edge"]
+        self._run_model({
+            "pixel_values": torch.zeros(1, 3, edge, edge),
+            "pixel_mask": torch.ones(1, edge, edge, dtype=torch.long),
+        })
+
+    def _run_model(self, inputs):
+        """Run DETR on preprocessed inputs and return its outputs in float32."""
+        # Both models share the process, so the thread settings of this one are applied before every run
+        self.profile.apply()
+
+        # Move the inputs to the model's device, matching its (possibly reduced) precision
+        inputs = {key: val.to(self.device, self.model.dtype) if val.is_floating_point() else val.to(self.device) for key, val in inputs.items()}
+
+        with torch.no_grad():
+            outputs = self.model(**inputs)
+
+        # Post-processing runs in float32 whatever the precision of the weights
+        outputs.logits = outputs.logits.float()
+        outputs.pred_boxes = outputs.pred_boxes.float()
+        return outputs
+
+    def detect_images(self, images, inputs=None, with_scores=False):
+        """
+        Detect objects in a batch of loaded images with a single DETR forward pass.
+
+        Args:
+        - images (list of PIL.Image): The images to process.
+        - inputs (dict): Optional inputs already preprocessed for the batch (see BatchPreprocessor.py).
+        - with_scores (bool): Whether to return (object, best score) pairs instead of plain objects.
+
+        Returns:
+        - List with the detected objects of every image.
+        """
+        # Process the images and convert to tensors (padded to a common size with a pixel mask)
+        if inputs is None:
+            inputs = self.processor(images=images, return_tensors="pt")
+        target_sizes = torch.tensor([FusedPreprocessor.image_size(image) for image in images])
+        return self._detected_objects(self._run_model(inputs), target_sizes, with_scores)
+
+    def _detected_objects(self, outputs, target_sizes, with_scores=False):
+        """Turn DETR outputs into the list of unique detected objects of every image."""
+        # Convert the model's outputs (bounding boxes and class logits) to the COCO API format
+        results = self.processor.post_process_object_detection(outputs, target_sizes=target_sizes.to(self.device), threshold=0.9)
+
+        detected_objects = []
+        for result in results:
+            # Use a dictionary to store unique detected objects with their best score
+            detected_objects_scores = {}
+            for score, label, box in zip(result["scores"], result["labels"], result["boxes"]):
+                detected_object = self.model.config.id2label[label.item()]
+                detected_objects_scores[detected_object] = max(score.item(), detected_objects_scores.get(detected_object, 0))
+            if with_scores:
+                detected_objects.append(sorted(detected_objects_scores.items(), key=lambda item: item[1], reverse=True))
+            else:
+                detected_objects.append(list(detected_objects_scores))
+        return detected_objects
 
     def detect(self, image_path):
         """
@@ -23,23 +100,17 @@ class ObjectDetector:
         - List of detected objects in the image.
         """
 
-        # Open the image using PIL and correct its orientation if needed
-        image = ImageUtils.load_image(image_path)
+        with self.memory_budget.reserve(image_path) as max_pixels:
+            # Open the image using PIL and correct its orientation if needed
+            image = ImageUtils.load_image(image_path, max_pixels=max_pixels)
+            target_sizes = torch.tensor([image.size[::-1]])
 
-        # Process the image and convert to tensors
-        inputs = self.processor(images=image, return_tensors="pt").to(self.device)
+            # Process the image and convert to tensors
+            inputs = self.processor(images=image, return_tensors="pt")
+            del image
         
         # Run the model to detect objects
-        outputs = self.model(**inputs)
-
-        # Convert the model's outputs (bounding boxes and class logits) to the COCO API format
-        target_sizes = torch.tensor([image.size[::-1]]).to(self.device)
-        results = self.processor.post_process_object_detection(outputs, target_sizes=target_sizes, threshold=0.9)[0]
-
-        # Use a set to store unique detected objects
-        detected_objects_set = set()
-        for score, label, box in zip(results["scores"], results["labels"], results["boxes"]):
-            detected_objects_set.add(self.model.config.id2label[label.item()])
+        outputs = self._run_model(inputs)
 
         # Return the list of detected objects
-        return list(detected_objects_set)
\ No newline at end of file
+        return self._detected_objects(outputs, target_sizes)[0]
\ No newline at end of file
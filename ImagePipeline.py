@@ -0,0 +1,299 @@
+import multiprocessing
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+from BatchPreprocessor import FusedPreprocessor
+from ImageUtils import ImageUtils
+from MemoryBudget import MemoryBudget
+from SharedImageRing import SharedImageRing, decode_images
+
+class ImagePipeline:
+    """
+    Decode images on worker threads and run both models on batches of them.
+
+    The batch size and the number of decode workers come from the models'
+    tuning profiles unless given. The next batch is decoded while the current
+    one runs through the models, and every decoded image holds its share of
+    the memory budget until its batch is done. Both models' inputs are built
+    by one FusedPreprocessor pass unless fused_preprocessing is off. Images
+    that can't be decoded or processed are reported to run's on_error and
+    skipped without stopping the others.
+
+    With decode_processes, images are decoded in separate processes instead
+    of threads and handed over through a SharedImageRing. The ring's slots
+    then hold the decoded images in place of the memory budget's admission.
+    """
+    # Slot size when the memory budget is unlimited
+    _default_slot_pixels = 50 * 1000 ** 2
+    # Seconds between checks that the decoder processes are still alive
+    _decoder_poll_interval = 1
+
+    def __init__(self, classifier, detector, batch_size=None, decode_workers=None, memory_budget=None, fused_preprocessing=True, decode_processes=0):
+        self.classifier = classifier
+        self.detector = detector
+        # Models served remotely (InferenceClient) take paths, not decoded batches
+        self.remote = not hasattr(classifier, "predict_images")
+
+        profiles = [model.profile for model in (classifier, detector) if hasattr(model, "profile")]
+        self.batch_size = batch_size or min([profile.batch_size for profile in profiles], default=1)
+        if self.remote:
+            # For a server the workers are the requests in flight
+            self.decode_workers = decode_workers or getattr(classifier, "concurrency", 1)
+        else:
+            self.decode_workers = decode_workers or max([profile.decode_workers for profile in profiles], default=1)
+        self.memory_budget = memory_budget if memory_budget is not None else getattr(classifier, "memory_budget", MemoryBudget(budget_bytes=None))
+        # Images resized together may use the share of the budget a single image may use
+        self.preprocessor = None
+        if fused_preprocessing and not self.remote:
+            self.preprocessor = FusedPreprocessor(classifier.processor, detector.processor, self.memory_budget.max_image_bytes)
+        self.decode_processes = decode_processes
+
+    def run(self, image_paths, with_scores=False, on_error=None):
+        """
+        Classify and detect objects in images.
+
+        Args:
+        - image_paths (iterable of str): The images to process.
+        - with_scores (bool): Whether classes and objects come as (label, score) pairs.
+        - on_error (callable): Optional function called with (image_path, exception)
+            for every image that can't be read or processed, which is then skipped.
+            Without it the first failure is raised.
+
+        Yields:
+        - Tuple (image_path, classes, detected_objects) per image, in input order.
+        """
+        if self.remote:
+            yield from self._run_remote(image_paths, with_scores, on_error)
+            return
+        if self.decode_processes:
+            yield from self._run_processes(image_paths, with_scores, on_error)
+            return
+
+        decoding = []
+        current = []
+        with ThreadPoolExecutor(self.decode_workers) as pool:
+            try:
+                for image_path in image_paths:
+                    try:
+                        # Planning reads the image header, an unreadable file fails here
+                        reservation = self.memory_budget.acquire(image_path, blocking=False)
+                        if reservation is None:
+                            # Free memory by running the batches already decoded, then wait for the rest
+                            for batch in (decoding, current):
+                                yield from self._run_batch(batch, with_scores, on_error)
+                            decoding, current = [], []
+                            reservation = self.memory_budget.acquire(image_path)
+                    except Exception as e:
+                        self._fail(image_path, e, on_error)
+                        continue
+
+                    estimate, max_pixels = reservation
+                    current.append((image_path, pool.submit(ImageUtils.load_image, image_path, max_pixels), estimate))
+
+                    if len(current) == self.batch_size:
+                        # Run the previous batch while this one decodes
+                        yield from self._run_batch(decoding, with_scores, on_error)
+                        decoding, current = current, []
+
+                for batch in (decoding, current):
+                    yield from self._run_batch(batch, with_scores, on_error)
+                decoding, current = [], []
+            finally:
+                # Processing stopped early: wait for the decodes still running and give back their memory
+                for image_path, future, estimate in decoding + current:
+                    future.cancel() or future.exception()
+                    self.memory_budget.release(estimate)
+
+    @staticmethod
+    def _fail(image_path, error, on_error):
+        """Report a failing image to on_error, or raise its error when there is no handler."""
+        if on_error is None:
+            raise error
+        on_error(image_path, error)
+
+    def _predict(self, image_paths, images, with_scores=False, on_error=None):
+        """
+        Run both models on a batch of decoded images.
+
+        Returns:
+        - Tuple (image_paths, predictions, detected_objects) of the images the models succeeded on.
+        """
+        if not images:
+            return [], [], []
+        try:
+            vit_inputs, detr_inputs = self.preprocessor(images) if self.preprocessor is not None else (None, None)
+            predictions = self.classifier.predict_images(images, vit_inputs)
+            detected_objects = self.detector.detect_images(images, detr_inputs, with_scores)
+            return image_paths, predictions, detected_objects
+        except Exception as e:
+            if on_error is None or len(images) == 1:
+                self._fail(image_paths[0], e, on_error)
+                return [], [], []
+
+        # Run the batch image by image to find the ones the models fail on
+        results = ([], [], [])
+        for image_path, image in zip(image_paths, images):
+            for collected, values in zip(results, self._predict([image_path], [image], with_scores, on_error)):
+                collected.extend(values)
+        return results
+
+    def _run_batch(self, batch, with_scores=False, on_error=None):
+        """Run both models on a decoded batch and release its memory."""
+        if not batch:
+            return
+        try:
+            batch_paths = []
+            images = []
+            for image_path, future, _ in batch:
+                try:
+                    images.append(future.result())
+                    batch_paths.append(image_path)
+                except Exception as e:
+                    self._fail(image_path, e, on_error)
+            batch_paths, predictions, detected_objects = self._predict(batch_paths, images, with_scores, on_error)
+            del images
+        finally:
+            for _, _, estimate in batch:
+                self.memory_budget.release(estimate)
+            # The batch is released, don't release it again if the caller stops
+            batch.clear()
+
+        yield from self._results(batch_paths, predictions, detected_objects, with_scores)
+
+    def _run_shared_batch(self, batch, with_scores=False, on_error=None):
+        """Run both models on a batch of images held in ring slots and recycle the slots."""
+        if not batch:
+            return
+        try:
+            # Views of the shared memory, the pixels are not copied
+            images = [shared_image.array for _, shared_image in batch]
+            batch_paths = [image_path for image_path, _ in batch]
+            batch_paths, predictions, detected_objects = self._predict(batch_paths, images, with_scores, on_error)
+            del images
+        finally:
+            for _, shared_image in batch:
+                shared_image.release()
+            batch.clear()
+
+        yield from self._results(batch_paths, predictions, detected_objects, with_scores)
+
+    def _run_processes(self, image_paths, with_scores=False, on_error=None):
+        """Decode the images in decoder processes handing them over through a shared memory ring."""
+        context = multiprocessing.get_context("spawn")
+        # Enough slots for the batch running, the next one and an image per decoder
+        slot_count = 2 * self.batch_size + self.decode_processes
+        if self.memory_budget.budget_bytes:
+            slot_bytes = self.memory_budget.budget_bytes // slot_count
+        else:
+            slot_bytes = 3 * self._default_slot_pixels
+        ring = SharedImageRing(slot_count, slot_bytes, context)
+        tasks = context.Queue()
+        stop = context.Event()
+        decoders = [context.Process(target=decode_images, args=(ring, tasks, stop), daemon=True) for _ in range(self.decode_processes)]
+        for decoder in decoders:
+            decoder.start()
+
+        image_paths = iter(image_paths)
+        # Paths of the images submitted and not released yet, by submission index
+        paths = {}
+        # Images decoded ahead of the next one in input order
+        received = {}
+        batch = []
+        submitted = 0
+        next_index = 0
+        try:
+            while True:
+                # Never submit more images than slots, so every submitted image gets one
+                # even while earlier ones wait in received for an image decoded late
+                while len(paths) < slot_count:
+                    image_path = next(image_paths, None)
+                    if image_path is None:
+                        break
+                    paths[submitted] = image_path
+                    tasks.put((submitted, image_path))
+                    submitted += 1
+                if next_index == submitted:
+                    break
+
+                while next_index not in received:
+                    try:
+                        shared_image = ring.get(timeout=self._decoder_poll_interval)
+                    except queue.Empty:
+                        # A decoder killed mid-image (e.g. out of memory on a huge PNG) never hands it over
+                        dead = [decoder for decoder in decoders if not decoder.is_alive()]
+                        if dead:
+                            # It may have died holding the task queue's lock, the others can't be stopped cleanly
+                            for decoder in decoders:
+                                decoder.terminate()
+                            raise RuntimeError(f"Decoder process {dead[0].pid} exited with code {dead[0].exitcode}")
+                        continue
+                    received[shared_image.tag] = shared_image
+                shared_image = received.pop(next_index)
+                image_path = paths[next_index]
+                next_index += 1
+                if shared_image.error is not None:
+                    # The decoder holds no slot for an image it failed on
+                    del paths[shared_image.tag]
+                    self._fail(image_path, RuntimeError(shared_image.error), on_error)
+                    continue
+
+                batch.append((image_path, shared_image))
+                if len(batch) == self.batch_size:
+                    # The batch's slots are free again once it ran
+                    for _, batch_image in batch:
+                        del paths[batch_image.tag]
+                    yield from self._run_shared_batch(batch, with_scores, on_error)
+            yield from self._run_shared_batch(batch, with_scores, on_error)
+        finally:
+            stop.set()
+            for _ in decoders:
+                tasks.put(None)
+            for _, shared_image in batch:
+                shared_image.release()
+            for shared_image in received.values():
+                shared_image.release()
+            for decoder in decoders:
+                decoder.join(timeout=10)
+                if decoder.is_alive():
+                    decoder.terminate()
+            ring.close()
+
+    def _results(self, batch_paths, predictions, detected_objects, with_scores=False):
+        """Store the embeddings of a batch and yield its results."""
+        if self.classifier.embedding_store is not None:
+            self.classifier.embedding_store.add(batch_paths, [embedding for _, _, embedding in predictions])
+
+        for image_path, (classes, score, _), objects in zip(batch_paths, predictions, detected_objects):
+            if with_scores:
+                # Every synonym of the predicted class shares its probability
+                classes = [(label, score) for label in classes]
+            yield image_path, classes, objects
+
+    def _run_remote(self, image_paths, with_scores=False, on_error=None):
+        """Send the images to an inference server from several threads so its micro-batches fill up."""
+        def analyze(image_path):
+            try:
+                if self.classifier is self.detector:
+                    # One upload and decode on the server for both models
+                    classes, detected_objects = self.classifier.analyze(image_path)
+                else:
+                    classes = self.classifier.classify(image_path)
+                    detected_objects = self.detector.detect(image_path)
+            except Exception as e:
+                return image_path, None, None, e
+            if with_scores:
+                # The server doesn't report scores
+                classes = [(label, None) for label in classes]
+                detected_objects = [(label, None) for label in detected_objects]
+            return image_path, classes, detected_objects, None
+
+        pool = ThreadPoolExecutor(self.decode_workers)
+        try:
+            for image_path, classes, detected_objects, error in pool.map(analyze, image_paths):
+                if error is not None:
+                    self._fail(image_path, error, on_error)
+                    continue
+                yield image_path, classes, detected_objects
+        finally:
+            # Drop the requests not sent yet if processing stopped early
+            pool.shutdown(cancel_futures=True)
@@ -0,0 +1,175 @@
+import argparse
+import os
+import sys
+
+from ImageUtils import ImageUtils
+from PredictionManifest import PredictionManifest
+
+def find_images(folder_path, recursive=True):
+    """
+    List the images of a folder in path order.
+
+    Args:
+    - folder_path (str): The folder to scan.
+    - recursive (bool): Whether to include sub-folders.
+
+    Returns:
+    - List of absolute image paths.
+    """
+    folder_path = os.path.abspath(folder_path)
+    if not recursive:
+        return sorted(os.path.join(folder_path, f) for f in os.listdir(folder_path) if f.lower().endswith(ImageUtils.image_extensions))
+
+    image_paths = []
+    for directory, subdirectories, files in os.walk(folder_path):
+        subdirectories.sort()
+        image_paths.extend(os.path.join(directory, f) for f in sorted(files) if f.lower().endswith(ImageUtils.image_extensions))
+    return image_paths
+
+
+def load_pipeline(args):
+    """Load both models and the batched pipeline running them."""
+    from ImageClasifier import ImageClassifier
+    from ImageDetector import ObjectDetector
+    from ImagePipeline import ImagePipeline
+    from MemoryBudget import MemoryBudget
+
+    memory_budget = MemoryBudget.from_environment()
+    classifier = ImageClassifier(memory_budget=memory_budget, dtype=args.dtype, warmup=True)
+    detector = ObjectDetector(memory_budget=memory_budget, dtype=args.dtype, warmup=True)
+    return ImagePipeline(classifier, detector, batch_size=args.batch_size, decode_workers=args.decode_workers, memory_budget=memory_budget, decode_processes=args.decode_processes)
+
+
+def predict(args):
+    """Run both models over a library and append their predictions to a manifest."""
+    manifest = PredictionManifest(args.manifest)
+    # Images already in the manifest come from an earlier, possibly interrupted, run
+    done_paths = manifest.paths()
+    image_paths = [path for path in find_images(args.folder, not args.no_recursive) if path not in done_paths]
+    print(f"{len(image_paths)} images to predict ({len(done_paths)} already in the manifest)")
+
+    def skip(image_path, error):
+        print(f"Skipping {image_path}: {error}")
+        manifest.append_failure(image_path, error)
+
+    pipeline = load_pipeline(args)
+    for idx, (image_path, classes, detected_objects) in enumerate(pipeline.run(image_paths, with_scores=True, on_error=skip)):
+        manifest.append(image_path, classes, detected_objects)
+        if (idx + 1) % 100 == 0:
+            print(f"{idx + 1}/{len(image_paths)}")
+
+    failures = manifest.failures()
+    print(f"Done, {len(failures)} images in the manifest could not be processed")
+
+
+def apply(args):
+    """Write the keywords of a manifest into the images."""
+    prefix_map = tuple(args.replace_prefix) if args.replace_prefix else None
+    count, failures = PredictionManifest(args.manifest).apply(args.raw, args.overwrite, args.workers, args.min_score, prefix_map)
+    print(f"Tags written for {count} images")
+    if failures:
+        print(f"{len(failures)} images could not be written:")
+        for image_path, error in failures:
+            print(f"  {image_path}: {error}")
+
+
+def tag_unit(pipeline, image_writer, lease, image_paths, args):
+    """
+    Tag the images of a leased unit, recording the ones that fail instead of giving up the unit.
+
+    Returns:
+    - False if another worker reclaimed the unit meanwhile, True otherwise.
+    """
+    from contextlib import closing
+    from PredictionManifest import Prediction
+
+    def skip(image_path, error):
+        print(f"Skipping {image_path}: {error}")
+        lease.record_failure(image_path, error)
+
+    with closing(pipeline.run(image_paths, on_error=skip)) as results:
+        for image_path, classes, detected_objects in results:
+            # Another worker reclaimed the unit, leave the rest to it
+            if lease.lost.is_set():
+                return False
+            try:
+                image_writer.writeTagsFromPredictionsInImages([Prediction(image_path, classes + detected_objects)], args.raw, args.overwrite)
+            except Exception as e:
+                skip(image_path, e)
+                continue
+            lease.record(image_path)
+    return True
+
+
+def distributed(args):
+    """Process a library together with other workers sharing its filesystem, writing tags directly."""
+    from ImageWriter import ImageWriter
+    from ShardCoordinator import ShardCoordinator
+
+    coordinator = ShardCoordinator(args.folder, args.coordination_dir, args.worker_id, args.chunk_size, args.lease_timeout, args.heartbeat_interval)
+    print(f"Worker {coordinator.worker_id}: {coordinator.pending()} of {len(coordinator.units())} units left")
+
+    pipeline = load_pipeline(args)
+    image_writer = ImageWriter()
+    processed_units = 0
+    while True:
+        lease = coordinator.claim()
+        if lease is None:
+            break
+        with lease:
+            if tag_unit(pipeline, image_writer, lease, coordinator.unit_images(lease.unit), args):
+                lease.complete()
+                processed_units += 1
+                print(f"Unit {lease.unit['directory']} #{lease.unit['chunk']} done")
+    print(f"Worker {coordinator.worker_id}: processed {processed_units} units, no units left to claim")
+
+    failures = coordinator.failures()
+    if failures:
+        print(f"{len(failures)} images failed (listed in {os.path.join(coordinator.coordination_dir, 'failures')}):")
+        for image_path, error in failures:
+            print(f"  {image_path}: {error}")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Tag a photo library without the graphical application.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    predict_parser = subparsers.add_parser("predict", help="Predict keywords for a folder into a manifest.")
+    predict_parser.add_argument("folder", help="Folder with the images.")
+    predict_parser.add_argument("--manifest", required=True, help="JSON-lines manifest the predictions are appended to.")
+    predict_parser.add_argument("--no-recursive", action="store_true", help="Don't process sub-folders.")
+    predict_parser.add_argument("--batch-size", type=int, default=None, help="Images per batch (defaults to the tuned profile).")
+    predict_parser.add_argument("--decode-workers", type=int, default=None, help="Decoding threads (defaults to the tuned profile).")
+    predict_parser.add_argument("--decode-processes", type=int, default=0, help="Decode in this many processes sharing memory with the models instead of threads.")
+    predict_parser.add_argument("--dtype", default=None, help="Load the models in reduced precision (bfloat16 or float16).")
+    predict_parser.set_defaults(func=predict)
+
+    apply_parser = subparsers.add_parser("apply", help="Write the keywords of a manifest into the images.")
+    apply_parser.add_argument("manifest", help="JSON-lines manifest written by predict.")
+    apply_parser.add_argument("--raw", action="store_true", help="Also write the matching DNG files.")
+    apply_parser.add_argument("--overwrite", action="store_true", help="Replace the existing keywords.")
+    apply_parser.add_argument("--workers", type=int, default=1, help="Worker processes writing directories in parallel.")
+    apply_parser.add_argument("--min-score", type=float, default=0.0, help="Leave out keywords scoring below this.")
+    apply_parser.add_argument("--replace-prefix", nargs=2, metavar=("OLD", "NEW"), help="Rewrite image paths starting with OLD to start with NEW.")
+    apply_parser.set_defaults(func=apply)
+
+    distributed_parser = subparsers.add_parser("distributed", help="Tag a library shared by several workers over a common filesystem.")
+    distributed_parser.add_argument("folder", help="Root folder of the library, the same for every worker.")
+    distributed_parser.add_argument("--coordination-dir", default=None, help="Shared folder for the unit plan and leases (defaults to .imagelabelia-shards in the library).")
+    distributed_parser.add_argument("--worker-id", default=None, help="Unique worker name (defaults to host, process id and a random suffix).")
+    distributed_parser.add_argument("--chunk-size", type=int, default=500, help="Images per work unit in large directories.")
+    distributed_parser.add_argument("--lease-timeout", type=float, default=300, help="Seconds without heartbeat before a unit is reclaimed.")
+    distributed_parser.add_argument("--heartbeat-interval", type=float, default=30, help="Seconds between lease heartbeats.")
+    distributed_parser.add_argument("--raw", action="store_true", help="Also write the matching DNG files.")
+    distributed_parser.add_argument("--overwrite", action="store_true", help="Replace the existing keywords.")
+    distributed_parser.add_argument("--batch-size", type=int, default=None, help="Images per batch (defaults to the tuned profile).")
+    distributed_parser.add_argument("--decode-workers", type=int, default=None, help="Decoding threads (defaults to the tuned profile).")
+    distributed_parser.add_argument("--decode-processes", type=int, default=0, help="Decode in this many processes sharing memory with the models instead of threads.")
+    distributed_parser.add_argument("--dtype", default=None, help="Load the models in reduced precision (bfloat16 or float16).")
+    distributed_parser.set_defaults(func=distributed)
+    return parser
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    sys.exit(args.func(args))
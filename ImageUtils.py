@@ -2,6 +2,9 @@ from PIL import Image, ExifTags
 from iptcinfo3 import IPTCInfo
 
 class ImageUtils:
+    # Extensions of the image files the application processes
+    image_extensions = ('.png', '.jpg', '.jpeg')
+
     @staticmethod
     def correct_image_orientation(image) -> Image:
         """Corrects the orientation of an image using its Exif data."""
@@ -30,12 +33,14 @@ class ImageUtils:
         return image
 
     @staticmethod
-    def load_image(image_path) -> Image:
+    def load_image(image_path, max_pixels=None) -> Image:
         """Load an image from the specified file path
             and process it.
 
         Args:
         - image_path (str): The path to the image file.
+        - max_pixels (int): Optional pixel count above which the image is
+            decoded at reduced size.
 
         Returns:
         - image (PIL.Image): The loaded image in RGB format with orientation
@@ -43,6 +48,11 @@ class ImageUtils:
         """
         # Open the image using PIL
         image = Image.open(image_path)
+
+        # Shrink oversized images while decoding (JPEG decodes straight at a reduced scale)
+        if max_pixels and image.width * image.height > max_pixels:
+            scale = (max_pixels / (image.width * image.height)) ** 0.5
+            image.thumbnail((max(1, int(image.width * scale)), max(1, int(image.height * scale))))
         
         # Correct its orientation and ensure it's in RGB format
         image = ImageUtils.correct_image_orientation(image)
@@ -51,12 +61,27 @@ class ImageUtils:
         return image
 
     @staticmethod
-    def generate_thumbnail(image_path, base_size=75):
+    def generate_thumbnail(image_path, base_size=75, memory_budget=None):
         """
         Generate a thumbnail for the given image while maintaining aspect ratio.
         Also corrects the orientation based on the image's EXIF data.
+
+        The image is decoded at reduced size (JPEG straight at a reduced scale,
+        without a full resolution bitmap). It is counted in memory_budget when
+        given and it fits, but never waits for it: thumbnails are built on the
+        UI thread, which the processing thread waits on while holding budget.
         """
-        img = ImageUtils.load_image(image_path)
+        # Twice the thumbnail size leaves the final resize some detail to work with
+        max_pixels = (2 * base_size) ** 2
+        reservation = memory_budget.acquire(image_path, blocking=False, max_pixels=max_pixels) if memory_budget is not None else None
+        if reservation is None:
+            img = ImageUtils.load_image(image_path, max_pixels=max_pixels)
+        else:
+            estimate, reduced_pixels = reservation
+            try:
+                img = ImageUtils.load_image(image_path, max_pixels=reduced_pixels or max_pixels)
+            finally:
+                memory_budget.release(estimate)
 
         # Resize while maintaining aspect ratio
         aspect_ratio = img.width / img.height
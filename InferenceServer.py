@@ -0,0 +1,226 @@
+import argparse
+import io
+import json
+import queue
+import threading
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from ImageUtils import ImageUtils
+from MemoryBudget import MemoryBudget
+
+class MicroBatcher:
+    """
+    Collect concurrent requests into batches for a single worker thread.
+
+    A batch is closed when it reaches max_batch_size or when its first request
+    has waited max_latency_ms, so a lone request pays at most the latency budget
+    while concurrent ones share one forward pass.
+    """
+
+    def __init__(self, process_batch, max_batch_size=8, max_latency_ms=20):
+        """
+        Args:
+        - process_batch (callable): Function mapping a list of items to a list of results.
+        - max_batch_size (int): Largest batch handed to process_batch.
+        - max_latency_ms (float): Longest time the first request of a batch waits for others.
+        """
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000
+        self._queue = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, item):
+        """Queue an item and return a Future resolved with its result."""
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_latency
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                results = self.process_batch([item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+
+class InferenceServer(ThreadingHTTPServer):
+    """
+    HTTP server hosting the ViT classifier and the DETR detector.
+
+    Clients POST the encoded image file to /classify, /detect or /analyze (both
+    models) and receive JSON. Requests for the same model are micro-batched.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, classifier, detector, max_batch_size=8, max_latency_ms=20, memory_budget=None):
+        super().__init__(address, InferenceRequestHandler)
+        self.classifier_batcher = MicroBatcher(classifier.predict_images, max_batch_size, max_latency_ms)
+        self.detector_batcher = MicroBatcher(detector.detect_images, max_batch_size, max_latency_ms)
+        self.memory_budget = memory_budget if memory_budget is not None else MemoryBudget()
+
+    def analyze(self, data, classify, detect, with_embedding=False):
+        """
+        Run the requested models on an encoded image.
+
+        Args:
+        - data (bytes): The encoded image file.
+        - classify (bool): Whether to run the classifier.
+        - detect (bool): Whether to run the detector.
+        - with_embedding (bool): Whether to return the ViT embedding.
+
+        Returns:
+        - Dictionary with the "classes", "objects" and "embedding" that were requested.
+        """
+        with self.memory_budget.reserve(io.BytesIO(data)) as max_pixels:
+            image = ImageUtils.load_image(io.BytesIO(data), max_pixels=max_pixels)
+            # Both models work on the image at the same time, each in its own batch
+            classifier_future = self.classifier_batcher.submit(image) if classify else None
+            detector_future = self.detector_batcher.submit(image) if detect else None
+
+            response = {}
+            if classifier_future is not None:
+                classes, _, embedding = classifier_future.result()
+                response["classes"] = classes
+                if with_embedding:
+                    response["embedding"] = embedding.tolist()
+            if detector_future is not None:
+                response["objects"] = detector_future.result()
+        return response
+
+
+class InferenceRequestHandler(BaseHTTPRequestHandler):
+    # Models run by each endpoint as (classify, detect)
+    _endpoints = {
+        "/classify": (True, False),
+        "/detect": (False, True),
+        "/analyze": (True, True),
+    }
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path not in self._endpoints:
+            self.send_error(404)
+            return
+
+        classify, detect = self._endpoints[url.path]
+        with_embedding = urllib.parse.parse_qs(url.query).get("embedding") == ["1"]
+        data = self.rfile.read(int(self.headers["Content-Length"]))
+        try:
+            response = self.server.analyze(data, classify, detect, with_embedding)
+        except Exception as e:
+            self.send_error(500, str(e))
+            return
+
+        body = json.dumps(response).encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Keep the console quiet, one line per request is too much under load
+        pass
+
+
+class InferenceClient:
+    """
+    Client of an InferenceServer exposing the ImageClassifier and ObjectDetector interface.
+
+    The app uses it in place of the local models when a server is configured.
+    """
+
+    def __init__(self, url, timeout=300, concurrency=8):
+        """
+        Args:
+        - url (str): Base URL of the server.
+        - timeout (float): Seconds to wait for a response.
+        - concurrency (int): Requests in flight at once when processing a folder,
+            enough to fill the server's micro-batches.
+        """
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.concurrency = concurrency
+        # Optional EmbeddingStore where the embedding of every classified image is appended
+        self.embedding_store = None
+
+    def _post(self, endpoint, image_path):
+        with open(image_path, 'rb') as f:
+            data = f.read()
+        request = urllib.request.Request(self.url + endpoint, data=data, headers={"Content-Type": "application/octet-stream"})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.load(response)
+
+    def classify(self, image_path):
+        """Classify an image on the server, returning the list of predicted classes."""
+        if self.embedding_store is None:
+            return self._post("/classify", image_path)["classes"]
+
+        response = self._post("/classify?embedding=1", image_path)
+        self.embedding_store.add([image_path], [response["embedding"]])
+        return response["classes"]
+
+    def analyze(self, image_path):
+        """
+        Classify and detect objects in an image with a single request.
+
+        Returns:
+        - Tuple (classes, detected_objects).
+        """
+        if self.embedding_store is None:
+            response = self._post("/analyze", image_path)
+        else:
+            response = self._post("/analyze?embedding=1", image_path)
+            self.embedding_store.add([image_path], [response["embedding"]])
+        return response["classes"], response["objects"]
+
+    def embed(self, image_path):
+        """Compute the ViT embedding of an image on the server."""
+        return self._post("/classify?embedding=1", image_path)["embedding"]
+
+    def detect(self, image_path):
+        """Detect objects in an image on the server, returning the list of detected objects."""
+        return self._post("/detect", image_path)["objects"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the ViT classifier and DETR detector over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1", help="Interface to listen on.")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on.")
+    parser.add_argument("--max-batch-size", type=int, default=8, help="Largest micro-batch per model.")
+    parser.add_argument("--max-latency-ms", type=float, default=20, help="Longest wait for a micro-batch to fill.")
+    parser.add_argument("--dtype", default=None, help="Load the models in reduced precision (bfloat16 or float16).")
+    args = parser.parse_args()
+
+    from ImageClasifier import ImageClassifier
+    from ImageDetector import ObjectDetector
+
+    server = InferenceServer(
+        (args.host, args.port),
+        ImageClassifier(dtype=args.dtype, warmup=True),
+        ObjectDetector(dtype=args.dtype, warmup=True),
+        max_batch_size=args.max_batch_size,
+        max_latency_ms=args.max_latency_ms,
+    )
+    print(f"Serving on http://{args.host}:{args.port}")
+    server.serve_forever()
@@ -0,0 +1,121 @@
+import os
+import threading
+from contextlib import contextmanager
+
+from PIL import Image
+
+class MemoryBudget:
+    """
+    Admission control for decoded image memory.
+
+    Each image's decoded footprint is estimated from its header dimensions
+    before decoding, and work is only admitted while the total in-flight
+    estimate stays under the budget. Images too large to fit in a fraction of
+    the budget are decoded at reduced size instead.
+    """
+    # Pillow keeps RGB at 4 bytes per pixel; the decoded bitmap, its oriented RGB
+    # copy and the processor's NumPy array (3 bytes per pixel) are alive together
+    _bytes_per_pixel = 4 + 4 + 3
+    # Bytes per pixel of the bitmap decoded before an outlier can be reduced
+    _decode_bytes_per_pixel = 4
+    # Formats Pillow can decode directly at a reduced scale
+    _draft_formats = ('JPEG', 'MPO')
+
+    def __init__(self, budget_bytes=2 * 1024 ** 3, max_image_fraction=0.5):
+        """
+        Args:
+        - budget_bytes (int): Maximum decoded bytes in flight, None for no limit.
+        - max_image_fraction (float): Share of the budget a single image may use
+            before it is decoded at reduced size.
+        """
+        self.budget_bytes = budget_bytes
+        self.max_image_bytes = int(budget_bytes * max_image_fraction) if budget_bytes else None
+        self.in_flight_bytes = 0
+        self._condition = threading.Condition()
+
+    @classmethod
+    def from_environment(cls):
+        """Create the budget configured by IMAGELABELIA_MEMORY_BUDGET_MB (2GB by default)."""
+        return cls(int(os.environ.get("IMAGELABELIA_MEMORY_BUDGET_MB", 2048)) * 1024 ** 2)
+
+    def plan(self, image_path, max_pixels=None):
+        """
+        Plan the decoding of an image from its header.
+
+        Args:
+        - image_path (str): The path to the image file.
+        - max_pixels (int): Optional pixel count the caller reduces the image to
+            anyway, such as a thumbnail's.
+
+        Returns:
+        - Tuple (estimated_bytes, max_pixels) where max_pixels is None when the
+            image can be decoded at full resolution.
+        """
+        # Opening an image only parses its header, pixels are decoded lazily
+        with Image.open(image_path) as image:
+            pixels = image.width * image.height
+            image_format = image.format
+
+        estimate = pixels * self._bytes_per_pixel
+        if estimate <= self.max_image_bytes and (max_pixels is None or pixels <= max_pixels):
+            return estimate, None
+
+        budget_max_pixels = self.max_image_bytes // self._bytes_per_pixel
+        max_pixels = min(max_pixels, budget_max_pixels) if max_pixels is not None else budget_max_pixels
+        estimate = max_pixels * self._bytes_per_pixel
+        if image_format not in self._draft_formats:
+            # Without draft decoding the full bitmap exists until it is reduced
+            estimate += pixels * self._decode_bytes_per_pixel
+        return min(estimate, self.budget_bytes), max_pixels
+
+    def acquire(self, image_path, blocking=True, max_pixels=None):
+        """
+        Take the image's share of the budget, waiting for it to fit if blocking.
+
+        Args:
+        - image_path (str): The path to the image file.
+        - blocking (bool): Whether to wait when the image doesn't fit right now.
+        - max_pixels (int): Optional pixel count the caller reduces the image to (see plan).
+
+        Returns:
+        - Tuple (estimated_bytes, max_pixels) to pass to release and
+            ImageUtils.load_image, or None if not blocking and the image doesn't fit.
+        """
+        if self.budget_bytes is None:
+            return 0, max_pixels
+
+        estimate, max_pixels = self.plan(image_path, max_pixels)
+        with self._condition:
+            # An image is always admitted when nothing else is in flight so outliers cannot starve
+            while self.in_flight_bytes and self.in_flight_bytes + estimate > self.budget_bytes:
+                if not blocking:
+                    return None
+                self._condition.wait()
+            self.in_flight_bytes += estimate
+        return estimate, max_pixels
+
+    def release(self, estimate):
+        """Give back a share taken with acquire."""
+        if self.budget_bytes is None:
+            return
+        with self._condition:
+            self.in_flight_bytes -= estimate
+            self._condition.notify_all()
+
+    @contextmanager
+    def reserve(self, image_path, max_pixels=None):
+        """
+        Block until the image fits in the budget and hold its share while in use.
+
+        Args:
+        - image_path (str): The path to the image file.
+        - max_pixels (int): Optional pixel count the caller reduces the image to (see plan).
+
+        Yields:
+        - The max_pixels value to pass to ImageUtils.load_image.
+        """
+        estimate, max_pixels = self.acquire(image_path, max_pixels=max_pixels)
+        try:
+            yield max_pixels
+        finally:
+            self.release(estimate)
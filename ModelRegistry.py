@@ -0,0 +1,182 @@
+import json
+import os
+import shutil
+import uuid
+
+import numpy as np
+import torch
+
+from AppPaths import AppPaths
+
+class ModelRegistry:
+    """
+    Local registry of pretrained models stored as safetensors.
+
+    Models are looked up in a local directory (one folder per model id) and
+    their weights are memory-mapped instead of read into private memory, so
+    several processes loading the same model share its pages. A model missing
+    from the registry is fetched from the Huggingface hub once, unless the
+    registry is offline.
+    """
+    _weights_name = "model.safetensors"
+    # Tensor types of the safetensors format
+    _dtypes = {
+        "F64": torch.float64,
+        "F32": torch.float32,
+        "F16": torch.float16,
+        "BF16": torch.bfloat16,
+        "I64": torch.int64,
+        "I32": torch.int32,
+        "I16": torch.int16,
+        "I8": torch.int8,
+        "U8": torch.uint8,
+        "BOOL": torch.bool,
+    }
+
+    def __init__(self, root=None, offline=None):
+        """
+        Args:
+        - root (str): Registry directory, defaults to IMAGELABELIA_MODELS or the application data folder.
+        - offline (bool): Never contact the hub, defaults to IMAGELABELIA_OFFLINE=1.
+        """
+        self.root = root or os.environ.get("IMAGELABELIA_MODELS") or AppPaths.data_dir("models")
+        self.offline = offline if offline is not None else os.environ.get("IMAGELABELIA_OFFLINE") == "1"
+
+    @staticmethod
+    def parse_dtype(dtype):
+        """Convert a dtype name such as "float16" or "bfloat16" to a torch dtype (None stays None)."""
+        if dtype is None or isinstance(dtype, torch.dtype):
+            return dtype
+        return getattr(torch, dtype)
+
+    def model_dir(self, model_id):
+        """Return the registry folder of a model id."""
+        return os.path.join(self.root, model_id.replace("/", "--"))
+
+    def _populate(self, model_cls, processor_cls, model_id):
+        """Fetch a model from the hub and store it in the registry."""
+        path = self.model_dir(model_id)
+        if self.offline:
+            raise FileNotFoundError(f"Model {model_id} is not in the registry at {path} and offline mode is enabled")
+
+        # Save into a temporary folder first so an interrupted download never looks complete,
+        # named per process since processes starting together may populate the same model
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            processor_cls.from_pretrained(model_id).save_pretrained(temp_path)
+            model_cls.from_pretrained(model_id).save_pretrained(temp_path, safe_serialization=True)
+            try:
+                os.rename(temp_path, path)
+            except OSError:
+                # Another process stored the model first
+                if not os.path.isdir(path):
+                    raise
+        finally:
+            shutil.rmtree(temp_path, ignore_errors=True)
+
+    @classmethod
+    def load_weights(cls, weights_path):
+        """
+        Memory-map the tensors of a safetensors file.
+
+        Args:
+        - weights_path (str): Path to the .safetensors file.
+
+        Returns:
+        - Dictionary of tensor name to tensors backed by the file mapping.
+        """
+        with open(weights_path, 'rb') as f:
+            header_size = int.from_bytes(f.read(8), 'little')
+            header = json.loads(f.read(header_size))
+        header.pop("__metadata__", None)
+
+        # Copy-on-write mapping: clean pages stay shared between every process mapping the file
+        data = np.memmap(weights_path, dtype=np.uint8, mode='c', offset=8 + header_size)
+
+        state = {}
+        for name, info in header.items():
+            start, end = info["data_offsets"]
+            dtype = cls._dtypes[info["dtype"]]
+            if end > start:
+                tensor = torch.frombuffer(data[start:end], dtype=dtype)
+            else:
+                tensor = torch.empty(0, dtype=dtype)
+            state[name] = tensor.reshape(info["shape"])
+        return state
+
+    def _weights_path(self, path, dtype):
+        """Return the weights file for a dtype, storing a converted copy the first time it is requested."""
+        weights_path = os.path.join(path, self._weights_name)
+        if dtype is None or dtype == torch.float32:
+            return weights_path
+
+        variant_path = os.path.join(path, f"model.{str(dtype).replace('torch.', '')}.safetensors")
+        if not os.path.exists(variant_path):
+            from safetensors.torch import save_file
+
+            state = {
+                name: (tensor.to(dtype) if tensor.is_floating_point() else tensor).contiguous()
+                for name, tensor in self.load_weights(weights_path).items()
+            }
+            # Unique temporary name so processes converting at the same time don't write into one file;
+            # replacing a variant another process stored meanwhile is harmless, both are the same
+            temp_path = f"{variant_path}.{uuid.uuid4().hex}.tmp"
+            try:
+                save_file(state, temp_path, metadata={"format": "pt"})
+                os.replace(temp_path, variant_path)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+        return variant_path
+
+    @staticmethod
+    def _assign_weights(model, state):
+        """Install tensors as the model's parameters and buffers without copying them."""
+        for name, tensor in state.items():
+            module_name, _, attr = name.rpartition(".")
+            try:
+                module = model.get_submodule(module_name)
+            except AttributeError:
+                continue
+            if attr in module._parameters:
+                module._parameters[attr] = torch.nn.Parameter(tensor, requires_grad=False)
+            elif attr in module._buffers:
+                module._buffers[attr] = tensor
+        model.tie_weights()
+
+    def load(self, model_cls, processor_cls, model_id, dtype=None):
+        """
+        Load a model and its processor from the registry.
+
+        Args:
+        - model_cls: Transformers model class, e.g. ViTForImageClassification.
+        - processor_cls: Transformers processor class, e.g. ViTImageProcessor.
+        - model_id (str): Huggingface hub id of the model.
+        - dtype (torch.dtype or str): Optional weights dtype (float16 or bfloat16), stored once in the registry.
+
+        Returns:
+        - Tuple (processor, model) with the model in evaluation mode on the CPU.
+        """
+        path = self.model_dir(model_id)
+        if not os.path.isdir(path):
+            self._populate(model_cls, processor_cls, model_id)
+
+        dtype = self.parse_dtype(dtype)
+        weights_path = self._weights_path(path, dtype)
+
+        config = model_cls.config_class.from_pretrained(path)
+        if hasattr(config, "use_pretrained_backbone"):
+            # Backbone weights are part of the checkpoint, don't let timm download them again
+            config.use_pretrained_backbone = False
+
+        # Build the model without allocating weights, then point it at the mapped tensors
+        with torch.device("meta"):
+            model = model_cls(config)
+        self._assign_weights(model, self.load_weights(weights_path))
+
+        if any(tensor.is_meta for tensor in list(model.parameters()) + list(model.buffers())):
+            # Weights that are not in the checkpoint need the regular initialisation
+            model = model_cls.from_pretrained(path, config=config, torch_dtype=dtype)
+
+        processor = processor_cls.from_pretrained(path)
+        return processor, model.eval()
@@ -0,0 +1,158 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import groupby
+
+from ImageWriter import ImageWriter
+
+class Prediction:
+    def __init__(self, path, keywords):
+        self.path = path
+        self.keywords = keywords
+
+
+def _write_directory(predictions, applyToRaw, overwrite):
+    """
+    Write the tags of one directory's images (runs in a worker process).
+
+    Returns:
+    - Tuple (written_count, failures) where failures lists (image_path, error) pairs.
+    """
+    image_writer = ImageWriter()
+    written = 0
+    failures = []
+    for path, keywords in predictions:
+        # A missing or unwritable image must not abort the rest of the bulk write
+        try:
+            image_writer.writeTagsFromPredictionsInImages([Prediction(path, keywords)], applyToRaw, overwrite)
+        except Exception as e:
+            failures.append((path, str(e)))
+            continue
+        written += 1
+    return written, failures
+
+
+class PredictionManifest:
+    """
+    JSON-lines file of predictions waiting to be written into the images.
+
+    Each line holds an image path and its keywords with their score and the
+    model that predicted them, for example:
+
+        {"path": "/photos/cat.jpg", "keywords": [{"label": "tabby", "score": 0.91, "source": "classifier"}]}
+
+    Images that could not be processed get a line with the error instead of
+    keywords, so later runs skip them:
+
+        {"path": "/photos/broken.jpg", "error": "cannot identify image file"}
+
+    The file can be reviewed and edited by hand (removing keywords or whole
+    lines) between the prediction and the apply steps.
+    """
+
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+
+    def read(self):
+        """Return the records of the manifest, the last record of a path wins."""
+        records = {}
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A torn last line from an interrupted prediction run
+                        continue
+                    records[record["path"]] = record
+        except FileNotFoundError:
+            pass
+        return list(records.values())
+
+    def paths(self):
+        """Return the set of image paths already in the manifest, failed ones included."""
+        return {record["path"] for record in self.read()}
+
+    def failures(self):
+        """Return (image_path, error) pairs of the images that could not be processed."""
+        return [(record["path"], record["error"]) for record in self.read() if "error" in record]
+
+    def append(self, image_path, classes, detected_objects):
+        """
+        Add the predictions of an image to the manifest.
+
+        Args:
+        - image_path (str): Path of the image.
+        - classes (list): (label, score) pairs predicted by the classifier.
+        - detected_objects (list): (label, score) pairs predicted by the detector.
+        """
+        keywords = [
+            {"label": label, "score": round(score, 4) if score is not None else None, "source": source}
+            for source, labels in (("classifier", classes), ("detector", detected_objects))
+            for label, score in labels
+        ]
+        with open(self.manifest_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({"path": image_path, "keywords": keywords}) + "\n")
+
+    def append_failure(self, image_path, error):
+        """Record that an image could not be processed, so later runs skip it."""
+        with open(self.manifest_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({"path": image_path, "error": str(error)}) + "\n")
+
+    def predictions(self, min_score=0.0, prefix_map=None):
+        """
+        Return a Prediction per image with the keywords scoring at least min_score.
+
+        Args:
+        - min_score (float): Keywords scoring below this are left out.
+        - prefix_map (tuple): Optional (old, new) path prefixes, for manifests
+            predicted on a machine that mounts the library elsewhere.
+        """
+        predictions = []
+        for record in self.read():
+            if "error" in record:
+                continue
+            path = record["path"]
+            if prefix_map and path.startswith(prefix_map[0]):
+                path = prefix_map[1] + path[len(prefix_map[0]):]
+            keywords = []
+            for keyword in record["keywords"]:
+                score = keyword.get("score")
+                if (score is None or score >= min_score) and keyword["label"] not in keywords:
+                    keywords.append(keyword["label"])
+            predictions.append(Prediction(path, keywords))
+        return predictions
+
+    def apply(self, applyToRaw=False, overwrite=False, workers=1, min_score=0.0, prefix_map=None):
+        """
+        Write the manifest's keywords into the images' metadata.
+
+        Images are written directory by directory in path order to keep disk
+        access local, and directories are spread over worker processes.
+
+        Args:
+        - applyToRaw (bool): Whether to also write the matching DNG files.
+        - overwrite (bool): Whether to replace the existing keywords.
+        - workers (int): Number of worker processes.
+        - min_score (float): Keywords scoring below this are left out.
+        - prefix_map (tuple): Optional (old, new) path prefixes rewritten before writing.
+
+        Returns:
+        - Tuple (written_count, failures) where failures lists the (image_path, error)
+            pairs of the images that could not be written.
+        """
+        predictions = sorted(self.predictions(min_score, prefix_map), key=lambda prediction: os.path.split(prediction.path))
+        directories = [
+            [(prediction.path, prediction.keywords) for prediction in directory_predictions]
+            for _, directory_predictions in groupby(predictions, key=lambda prediction: os.path.dirname(prediction.path))
+        ]
+
+        if workers <= 1:
+            results = [_write_directory(directory, applyToRaw, overwrite) for directory in directories]
+        else:
+            with ProcessPoolExecutor(workers) as pool:
+                results = list(pool.map(_write_directory, directories, [applyToRaw] * len(directories), [overwrite] * len(directories)))
+        return sum(written for written, _ in results), [failure for _, failures in results for failure in failures]
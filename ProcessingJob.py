@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import time
+
+from AppPaths import AppPaths
+
+class ProcessingJob:
+    """
+    A processing run backed by an append-only journal on disk.
+
+    The journal is a JSON-lines file recording the input list, the predictions
+    of every processed image, which images already had their tags written and
+    which ones failed (so they are not retried on every resume).
+    Replaying it lets an interrupted run continue where it stopped without
+    repeating inference or metadata writes.
+    """
+
+    def __init__(self, journal_path):
+        self.journal_path = journal_path
+        self.inputs = []
+        self.options = {}
+        self.predictions = {}
+        self.written = set()
+        self.failed = {}
+        self.finished = False
+        self._replay()
+
+    @classmethod
+    def for_folder(cls, folder_path, image_files, apply_tags, jobs_dir=None):
+        """
+        Resume the unfinished job of a folder, or start a new one.
+
+        Args:
+        - folder_path (str): The processed folder, which identifies the job.
+        - image_files (list of str): Images currently in the folder.
+        - apply_tags (bool): Whether predictions are written to the images.
+        - jobs_dir (str): Optional folder holding the journals.
+
+        Returns:
+        - ProcessingJob ready to be processed.
+        """
+        jobs_dir = jobs_dir or AppPaths.data_dir("jobs")
+        job_id = hashlib.sha1(os.path.abspath(folder_path).encode('utf-8')).hexdigest()[:16]
+        job = cls(os.path.join(jobs_dir, job_id + ".jsonl"))
+
+        if job.inputs and not job.finished:
+            job.resume(image_files, apply_tags)
+        else:
+            job.start(image_files, apply_tags)
+        return job
+
+    @property
+    def resumed(self):
+        """Whether some of the inputs were already processed by a previous run."""
+        return bool(self.predictions)
+
+    def _replay(self):
+        """Rebuild the job state from the journal."""
+        try:
+            f = open(self.journal_path, 'r', encoding='utf-8')
+        except FileNotFoundError:
+            return
+
+        with f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn last line from an interrupted write
+                    break
+                event = record["event"]
+                if event == "start":
+                    self.inputs = record["inputs"]
+                    self.options = record["options"]
+                elif event == "inputs":
+                    self.inputs.extend(record["inputs"])
+                elif event == "removed":
+                    removed = set(record["inputs"])
+                    self.inputs = [path for path in self.inputs if path not in removed]
+                elif event == "options":
+                    self.options = record["options"]
+                elif event == "predicted":
+                    self.predictions[record["path"]] = record["keywords"]
+                elif event == "written":
+                    self.written.add(record["path"])
+                elif event == "failed":
+                    self.failed[record["path"]] = record["error"]
+                elif event == "finished":
+                    self.finished = True
+
+    def _append(self, record, truncate=False):
+        """Durably append a record to the journal."""
+        record["time"] = time.time()
+        with open(self.journal_path, 'w' if truncate else 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def start(self, image_files, apply_tags):
+        """Start a new job, replacing any previous journal."""
+        self.inputs = list(image_files)
+        self.options = {"apply_tags": apply_tags}
+        self.predictions = {}
+        self.written = set()
+        self.failed = {}
+        self.finished = False
+        self._append({"event": "start", "inputs": self.inputs, "options": self.options}, truncate=True)
+
+    def resume(self, image_files, apply_tags):
+        """Continue the job with the images currently in the folder, adding new ones and dropping deleted ones."""
+        current = set(image_files)
+        removed = [path for path in self.inputs if path not in current]
+        if removed:
+            self.inputs = [path for path in self.inputs if path in current]
+            self._append({"event": "removed", "inputs": removed})
+
+        known = set(self.inputs)
+        added = [path for path in image_files if path not in known]
+        if added:
+            self.inputs.extend(added)
+            self._append({"event": "inputs", "inputs": added})
+        if self.options.get("apply_tags") != apply_tags:
+            self.options = {"apply_tags": apply_tags}
+            self._append({"event": "options", "options": self.options})
+
+    def is_complete(self, image_path):
+        """Whether an image needs neither inference nor a metadata write, or failed in an earlier attempt."""
+        if image_path in self.failed:
+            return True
+        if image_path not in self.predictions:
+            return False
+        return image_path in self.written or not self.options.get("apply_tags")
+
+    def record_prediction(self, image_path, keywords):
+        """Record the predicted keywords of an image."""
+        self.predictions[image_path] = keywords
+        self._append({"event": "predicted", "path": image_path, "keywords": keywords})
+
+    def record_written(self, image_path):
+        """Record that the tags of an image were written to its metadata."""
+        self.written.add(image_path)
+        self._append({"event": "written", "path": image_path})
+
+    def record_failure(self, image_path, error):
+        """Record that an image could not be processed, so the job doesn't try it again."""
+        self.failed[image_path] = str(error)
+        self._append({"event": "failed", "path": image_path, "error": str(error)})
+
+    def finish(self):
+        """Mark the job as finished so the next run on the folder starts over."""
+        self.finished = True
+        self._append({"event": "finished"})
@@ -0,0 +1,295 @@
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+from ImageUtils import ImageUtils
+
+class Lease:
+    """
+    A claimed work unit kept alive by a heartbeat thread.
+
+    The heartbeat refreshes the lease file's modification time and checks the
+    file still names this worker. If another worker reclaimed the unit, lost
+    is set and the holder must stop writing.
+    """
+
+    def __init__(self, coordinator, unit, token):
+        self.coordinator = coordinator
+        self.unit = unit
+        self.token = token
+        self.lost = threading.Event()
+        self.completed = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._heartbeat, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self._stop.set()
+        self._thread.join()
+        if not self.completed:
+            # Hand the unit back so another worker picks it up right away
+            self.coordinator.release(self)
+        return False
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.coordinator.heartbeat_interval):
+            if not self.coordinator.renew(self):
+                self.lost.set()
+                return
+
+    def record(self, image_path):
+        """Record that an image of the unit is done, so a worker reclaiming the unit skips it."""
+        self.coordinator.record(self, image_path)
+
+    def record_failure(self, image_path, error):
+        """Record that an image of the unit failed, so no worker tries it again."""
+        self.coordinator.record_failure(self, image_path, error)
+
+    def complete(self):
+        """Mark the unit done and drop the lease."""
+        if self.lost.is_set():
+            return
+        self.coordinator.complete(self)
+        self.completed = True
+
+
+class ShardCoordinator:
+    """
+    Split a library into work units shared by several workers over a common filesystem.
+
+    Units are the images of one directory, split in chunks of chunk_size. The
+    unit plan lists the image names of every unit and is written once to
+    units.json in the coordination folder; images added to the library later
+    are left to a run with a fresh plan. Workers claim units by atomically
+    creating lease files (O_EXCL), keep them alive with heartbeats, and mark
+    them done. Leases whose heartbeat stopped for lease_timeout seconds are
+    reclaimed by other workers, which skip the images the previous holder
+    recorded as done. Images that fail are recorded too and not tried again.
+    Lease ages are measured against the shared filesystem's clock, not the
+    hosts' clocks.
+    """
+    _plan_name = "units.json"
+
+    def __init__(self, root, coordination_dir=None, worker_id=None, chunk_size=500, lease_timeout=300, heartbeat_interval=30):
+        self.root = os.path.abspath(root)
+        self.coordination_dir = os.path.abspath(coordination_dir or os.path.join(self.root, ".imagelabelia-shards"))
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.chunk_size = chunk_size
+        self.lease_timeout = lease_timeout
+        self.heartbeat_interval = heartbeat_interval
+
+        for name in ("leases", "done", "progress", "failures", "clock"):
+            os.makedirs(os.path.join(self.coordination_dir, name), exist_ok=True)
+        self._units = None
+
+    def _path(self, *parts):
+        return os.path.join(self.coordination_dir, *parts)
+
+    def _now(self):
+        """Current time of the shared filesystem, read from a file this worker touches."""
+        clock_path = self._path("clock", self.worker_id)
+        with open(clock_path, 'a'):
+            os.utime(clock_path)
+        return os.stat(clock_path).st_mtime
+
+    @staticmethod
+    def _create_exclusive(path, content):
+        """Atomically create a file, returning False if it already exists."""
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        return True
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path, 'r') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _scan(self, lock_path):
+        """List the work units of the library: chunks of a directory's image names."""
+        units = []
+        last_heartbeat = time.monotonic()
+        for directory, subdirectories, files in os.walk(self.root):
+            # Large libraries take a while, keep the scan lock alive meanwhile
+            if time.monotonic() - last_heartbeat > self.heartbeat_interval:
+                os.utime(lock_path)
+                last_heartbeat = time.monotonic()
+
+            subdirectories[:] = sorted(d for d in subdirectories if os.path.join(directory, d) != self.coordination_dir)
+            image_files = sorted(f for f in files if f.lower().endswith(ImageUtils.image_extensions))
+            relative = os.path.relpath(directory, self.root)
+            for chunk, start in enumerate(range(0, len(image_files), self.chunk_size)):
+                unit_id = hashlib.sha1(f"{relative}:{chunk}".encode('utf-8')).hexdigest()[:16]
+                # The names are fixed in the plan, files added or removed later don't move chunk boundaries
+                units.append({"id": unit_id, "directory": relative, "chunk": chunk, "files": image_files[start:start + self.chunk_size]})
+        return units
+
+    def units(self):
+        """Return the unit plan, scanning the library if no worker did it yet."""
+        if self._units is not None:
+            return self._units
+
+        plan_path = self._path(self._plan_name)
+        lock_path = self._path(self._plan_name + ".lock")
+        while not os.path.exists(plan_path):
+            if self._create_exclusive(lock_path, self.worker_id):
+                temp_path = self._path(f"{self._plan_name}.{self.worker_id}.tmp")
+                with open(temp_path, 'w') as f:
+                    json.dump({"chunk_size": self.chunk_size, "units": self._scan(lock_path)}, f)
+                os.replace(temp_path, plan_path)
+                try:
+                    os.remove(lock_path)
+                except FileNotFoundError:
+                    pass
+                break
+
+            # Another worker is scanning; take over if it died while doing so
+            try:
+                if self._now() - os.stat(lock_path).st_mtime > self.lease_timeout:
+                    os.remove(lock_path)
+            except FileNotFoundError:
+                pass
+            time.sleep(1)
+
+        with open(plan_path, 'r') as f:
+            plan = json.load(f)
+        # The chunk size of the plan, which may come from another worker's options
+        self.chunk_size = plan["chunk_size"]
+        self._units = plan["units"]
+        return self._units
+
+    def unit_images(self, unit):
+        """Return the paths of a unit's images that still exist and no previous holder recorded as done or failed."""
+        directory = os.path.normpath(os.path.join(self.root, unit["directory"]))
+        recorded = set((self._read(self._path("progress", unit["id"])) or "").splitlines())
+        recorded.update(line.split("\t", 1)[0] for line in (self._read(self._path("failures", unit["id"])) or "").splitlines())
+        image_paths = [os.path.join(directory, f) for f in unit["files"] if f not in recorded]
+        return [path for path in image_paths if os.path.exists(path)]
+
+    def _lease_content(self, token):
+        return json.dumps({"worker": self.worker_id, "token": token})
+
+    def _reclaim(self, lease_path):
+        """Break a lease whose heartbeat stopped, returning True if this worker broke it."""
+        content = self._read(lease_path)
+        try:
+            if content is None or self._now() - os.stat(lease_path).st_mtime <= self.lease_timeout:
+                return False
+            # Renaming is atomic, only one of the workers racing for the lease moves it away
+            stale_path = f"{lease_path}.{self.worker_id}.stale"
+            os.rename(lease_path, stale_path)
+        except FileNotFoundError:
+            return False
+
+        if self._read(stale_path) != content or self._now() - os.stat(stale_path).st_mtime <= self.lease_timeout:
+            # The lease was renewed or re-created in between: put it back untouched
+            try:
+                os.link(stale_path, lease_path)
+            except FileExistsError:
+                pass
+            os.remove(stale_path)
+            return False
+        os.remove(stale_path)
+        return True
+
+    def claim(self):
+        """
+        Claim the next unit that is neither done nor leased by a live worker.
+
+        While the only units left are leased by other workers, waits for them
+        to be done or for their leases to expire and be reclaimed.
+
+        Returns:
+        - A Lease to use as a context manager, or None when every unit is done.
+        """
+        units = self.units()
+        if not units:
+            return None
+
+        # Workers start at different units to avoid contending for the same leases
+        offset = int(hashlib.sha1(self.worker_id.encode('utf-8')).hexdigest(), 16) % len(units)
+        while True:
+            leased = False
+            for unit in units[offset:] + units[:offset]:
+                if os.path.exists(self._path("done", unit["id"])):
+                    continue
+                lease_path = self._path("leases", unit["id"])
+                token = uuid.uuid4().hex
+                if self._create_exclusive(lease_path, self._lease_content(token)):
+                    return Lease(self, unit, token)
+                if self._reclaim(lease_path) and self._create_exclusive(lease_path, self._lease_content(token)):
+                    return Lease(self, unit, token)
+                leased = True
+
+            if not leased:
+                return None
+            # The holder may have died, its lease expires after lease_timeout without heartbeat
+            time.sleep(self.heartbeat_interval)
+
+    def _owns(self, lease):
+        return self._read(self._path("leases", lease.unit["id"])) == self._lease_content(lease.token)
+
+    def renew(self, lease):
+        """Refresh a lease's heartbeat, returning False if the lease was lost."""
+        if not self._owns(lease):
+            return False
+        try:
+            os.utime(self._path("leases", lease.unit["id"]))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def record(self, lease, image_path):
+        """Append a finished image of a leased unit to the unit's progress file."""
+        with open(self._path("progress", lease.unit["id"]), 'a') as f:
+            f.write(os.path.basename(image_path) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def record_failure(self, lease, image_path, error):
+        """Append a failed image of a leased unit and its error to the unit's failures file."""
+        message = " ".join(str(error).split())
+        with open(self._path("failures", lease.unit["id"]), 'a') as f:
+            f.write(f"{os.path.basename(image_path)}\t{message}\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def failures(self):
+        """Return (image_path, error) pairs of the images that failed in any unit."""
+        failed = []
+        for unit in self.units():
+            directory = os.path.normpath(os.path.join(self.root, unit["directory"]))
+            for line in (self._read(self._path("failures", unit["id"])) or "").splitlines():
+                name, _, error = line.partition("\t")
+                failed.append((os.path.join(directory, name), error))
+        return failed
+
+    def complete(self, lease):
+        """Mark a leased unit done, then drop its lease."""
+        self._create_exclusive(self._path("done", lease.unit["id"]), self.worker_id)
+        self.release(lease)
+
+    def release(self, lease):
+        """Drop a lease if this worker still holds it."""
+        if self._owns(lease):
+            try:
+                os.remove(self._path("leases", lease.unit["id"]))
+            except FileNotFoundError:
+                pass
+
+    def pending(self):
+        """Number of units not marked done yet."""
+        return sum(1 for unit in self.units() if not os.path.exists(self._path("done", unit["id"])))
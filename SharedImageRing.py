@@ -0,0 +1,164 @@
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+class SharedImage:
+    """
+    A decoded image held in a slot of a SharedImageRing.
+
+    array is a NumPy view of the shared memory, valid until release() hands
+    the slot back to the decoders. When the producer failed, error holds its
+    message and there is neither slot nor array.
+    """
+
+    def __init__(self, ring, slot, array, tag, error=None):
+        self.ring = ring
+        self.slot = slot
+        self.array = array
+        self.tag = tag
+        self.error = error
+
+    def release(self):
+        """Give the slot back to the ring, the array must not be used anymore."""
+        if self.slot is None:
+            return
+        self.array = None
+        self.ring._free.put(self.slot)
+        self.slot = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.release()
+        return False
+
+
+class SharedImageRing:
+    """
+    Fixed slots of shared memory carrying decoded images from decoder processes to the inference process.
+
+    Producers copy a uint8 array (an oriented RGB bitmap or an already
+    preprocessed tensor) into a free slot and announce its slot, shape and
+    dtype on a small queue; only those few values are pickled. The consumer
+    reads the pixels as a view of the slot and releases it once done. Slots
+    are recycled through a queue of free slot numbers, so producers wait when
+    every slot is in use.
+
+    The ring is passed to the decoder processes as a Process argument. The
+    process that created it owns the shared memory and unlinks it on close().
+    """
+
+    def __init__(self, slot_count, slot_bytes, context=None):
+        """
+        Args:
+        - slot_count (int): Number of images that can be in flight at once.
+        - slot_bytes (int): Size of a slot, the largest image it can carry.
+        - context: Multiprocessing context of the decoder processes (spawn by default).
+        """
+        context = context or multiprocessing.get_context("spawn")
+        self.slot_count = slot_count
+        self.slot_bytes = slot_bytes
+        self._memory = shared_memory.SharedMemory(create=True, size=slot_count * slot_bytes)
+        self._owner = True
+        self._free = context.Queue()
+        self._ready = context.Queue()
+        for slot in range(slot_count):
+            self._free.put(slot)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # The shared memory is attached again by name in the other process
+        state["_memory"] = self._memory.name
+        state["_owner"] = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._memory = shared_memory.SharedMemory(name=state["_memory"])
+
+    @property
+    def slot_pixels(self):
+        """Largest RGB image a slot can carry, in pixels."""
+        return self.slot_bytes // 3
+
+    def _view(self, slot, shape, dtype):
+        return np.ndarray(shape, dtype=dtype, buffer=self._memory.buf, offset=slot * self.slot_bytes)
+
+    def put(self, array, tag=None, timeout=None):
+        """
+        Copy an array into a free slot and hand it to the consumer (producer side).
+
+        Args:
+        - array (array-like): The pixels, for example an RGB PIL image or an HWC uint8 array.
+        - tag: Picklable value returned with the image, identifying it to the consumer.
+        - timeout (float): Longest wait for a free slot, None to wait as long as needed.
+
+        Raises:
+        - ValueError: If the array doesn't fit in a slot.
+        - queue.Empty: If no slot got free within the timeout.
+        """
+        array = np.asarray(array)
+        if array.nbytes > self.slot_bytes:
+            raise ValueError(f"Image of {array.nbytes} bytes doesn't fit in a {self.slot_bytes} bytes slot")
+
+        slot = self._free.get(timeout=timeout)
+        self._view(slot, array.shape, array.dtype)[...] = array
+        self._ready.put((slot, array.shape, array.dtype.str, tag, None))
+
+    def put_error(self, tag, message):
+        """Report to the consumer that the image identified by tag could not be produced."""
+        self._ready.put((None, None, None, tag, message))
+
+    def get(self, timeout=None):
+        """
+        Take the next image handed over by a producer (consumer side).
+
+        Args:
+        - timeout (float): Longest wait for an image, None to wait as long as needed.
+
+        Returns:
+        - A SharedImage viewing the slot, to release once the pixels are used,
+            or carrying the error the producer reported for the image.
+
+        Raises:
+        - queue.Empty: If no image came within the timeout.
+        """
+        slot, shape, dtype, tag, error = self._ready.get(timeout=timeout)
+        if error is not None:
+            return SharedImage(self, None, None, tag, error)
+        return SharedImage(self, slot, self._view(slot, shape, dtype), tag)
+
+    def close(self):
+        """Detach from the shared memory, and free it in the process that created the ring."""
+        try:
+            self._memory.close()
+        except BufferError:
+            # A view is still referenced somewhere, the mapping goes away with the process
+            pass
+        if self._owner:
+            self._memory.unlink()
+
+
+def decode_images(ring, tasks, stop):
+    """
+    Decoder process: load images into the ring until a None task comes or stop is set.
+
+    Args:
+    - ring (SharedImageRing): Ring the decoded RGB bitmaps are written to.
+    - tasks (multiprocessing.Queue): (tag, image_path) pairs to decode.
+    - stop (multiprocessing.Event): Set by the consumer when it stops early.
+    """
+    from ImageUtils import ImageUtils
+
+    while True:
+        task = tasks.get()
+        if task is None or stop.is_set():
+            return
+        tag, image_path = task
+        try:
+            # Larger images are decoded at reduced size to fit in a slot
+            ring.put(ImageUtils.load_image(image_path, max_pixels=ring.slot_pixels), tag)
+        except Exception as e:
+            ring.put_error(tag, f"Could not decode {image_path}: {e}")
@@ -6,6 +6,7 @@ import tkinter as tk
 from tkinter import ttk
 from PIL import ImageTk
 import queue
+from contextlib import closing
 
 # Custom module imports
 from ImageClasifier import ImageClassifier
@@ -13,6 +14,14 @@ from ImageDetector import ObjectDetector
 from ImageWriter import ImageWriter
 from Translator import Translator
 from ImageUtils import ImageUtils
+from EmbeddingStore import EmbeddingStore
+from AppPaths import AppPaths
+from MemoryBudget import MemoryBudget
+from ModelRegistry import ModelRegistry
+from ProcessingJob import ProcessingJob
+from InferenceServer import InferenceClient
+from ImagePipeline import ImagePipeline
+from PredictionManifest import Prediction
 
 # Define some UI color constants
 DARK_COLOR = "#333"
@@ -22,12 +31,6 @@ TOAST_COLOR = "#777"
 TEXT_COLOR = "#FFF"
 SUCCESS_COLOR = "#006400"
 
-class Prediction:
-    def __init__(self, path, keywords):
-        self.path = path
-        self.keywords = keywords
-
-
 class ImageClassifierApp:
     
     def __init__(self, root):
@@ -40,9 +43,22 @@ class ImageClassifierApp:
         self.setup_treeview() 
         self.setup_preview_frame()
         # Initialize machine learning models and utility
-        self.vit_classifier = ImageClassifier()
-        self.detr_detector = ObjectDetector()
+        # Both models share one budget for the decoded pixels in flight
+        self.memory_budget = MemoryBudget.from_environment()
+        server_url = os.environ.get("IMAGELABELIA_SERVER")
+        if server_url:
+            # Client mode: both models are hosted by an inference server
+            server_concurrency = int(os.environ.get("IMAGELABELIA_SERVER_CONCURRENCY", 8))
+            self.vit_classifier = self.detr_detector = InferenceClient(server_url, concurrency=server_concurrency)
+        else:
+            # Models come from the local registry, optionally in reduced precision (IMAGELABELIA_DTYPE)
+            self.model_registry = ModelRegistry()
+            model_dtype = os.environ.get("IMAGELABELIA_DTYPE")
+            self.vit_classifier = ImageClassifier(memory_budget=self.memory_budget, registry=self.model_registry, dtype=model_dtype, warmup=True)
+            self.detr_detector = ObjectDetector(memory_budget=self.memory_budget, registry=self.model_registry, dtype=model_dtype, warmup=True)
+        self.pipeline = ImagePipeline(self.vit_classifier, self.detr_detector, memory_budget=self.memory_budget)
         self.image_writer = ImageWriter()
+        self.embedding_store = EmbeddingStore(AppPaths.data_dir("embeddings"))
         self.stop_requested = False  # Control variable for stopping a long process
         self.last_selected_folder = None
         self.all_thumbnails = []
@@ -104,6 +120,7 @@ class ImageClassifierApp:
         
         self.apply_to_raw = tk.BooleanVar(value=False)
         self.trust_ai = tk.BooleanVar(value=False)
+        self.store_embeddings = tk.BooleanVar(value=False)
             
         self.raw_option_chk = tk.Checkbutton(self.root, text=self.translator.translate("apply_raw_chk"), variable=self.apply_to_raw, bg=DARK_COLOR, fg=TEXT_COLOR, selectcolor=EVEN_DARKER_COLOR)
         self.raw_option_chk.grid(row=0, column=1, pady=10, sticky="w")
@@ -111,6 +128,9 @@ class ImageClassifierApp:
         self.trust_ai_chk = tk.Checkbutton(self.root, text=self.translator.translate("trust_ai_chk"), variable=self.trust_ai, bg=DARK_COLOR, fg=TEXT_COLOR, selectcolor=EVEN_DARKER_COLOR)
         self.trust_ai_chk.grid(row=0, column=2, pady=10, sticky="w")
 
+        self.store_embeddings_chk = tk.Checkbutton(self.root, text=self.translator.translate("store_embeddings_chk"), variable=self.store_embeddings, bg=DARK_COLOR, fg=TEXT_COLOR, selectcolor=EVEN_DARKER_COLOR)
+        self.store_embeddings_chk.grid(row=0, column=6, pady=10, sticky="w")
+
         self.progress_var = tk.DoubleVar()
         self.progress_bar = ttk.Progressbar(self.root, orient="horizontal", length=300, mode="determinate", variable=self.progress_var)
 
@@ -192,6 +212,16 @@ class ImageClassifierApp:
         
         self.apply_dark_theme_to_widget(self.apply_keywords_button)
 
+        self.find_similar_button = tk.Button(
+            self.preview_frame,
+            text=self.translator.translate("find_similar_btn"),
+            command=lambda: self.find_similar(self.file_path_label.cget("text"))
+        )
+
+        self.find_similar_button.pack(pady=5)
+
+        self.apply_dark_theme_to_widget(self.find_similar_button)
+
 
     def load_keywords_checkboxes(self, keywords):
         """Carga los checkboxes con los keywords actuales."""
@@ -275,41 +305,104 @@ class ImageClassifierApp:
         self.progress_bar.grid(row=0, column=3, pady=10)
         self.progress_label.grid(row=0, column=4, pady=10, padx=5)
 
+        # Only keep embeddings of the processed images when requested
+        self.vit_classifier.embedding_store = self.embedding_store if self.store_embeddings.get() else None
+
+        # Continue an interrupted run on this folder, or journal a new one
+        job = ProcessingJob.for_folder(folder_path, image_files, self.trust_ai.get())
+        if job.resumed:
+            self.show_toast(self.translator.translate("resuming_job"))
+
         # Start the thread to process the images
-        threading.Thread(target=self._process_images_in_folder, args=(folder_path, image_files)).start()
+        threading.Thread(target=self._process_images_in_folder, args=(folder_path, job)).start()
 
 
 
-    def _process_images_in_folder(self, folder_path, image_files):
+    def _process_images_in_folder(self, folder_path, job):
         """Classify and detect objects in images within a folder."""
-        total_images = len(image_files)
+        try:
+            self._run_job(folder_path, job)
+        except Exception as e:
+            # The job stays unfinished, the next run on the folder resumes it
+            print(f"ERROR: processing {folder_path} failed: {e}")
+        finally:
+            self.root.after(0, self.finish_processing)
+
+    def _run_job(self, folder_path, job):
+        """Run the images of a job that are not complete yet through the models."""
+        total_images = len(job.inputs)
         self.progress_bar["maximum"] = total_images
+        idx = 0
+        pending_paths = []
         
-        for idx, image_file in enumerate(image_files):
+        for image_file in job.inputs:
 
             if self.stop_requested:
                 self.stop_requested = False  
-                self.root.after(0, self.finish_processing)
                 return
 
             image_path = os.path.join(folder_path, image_file)
-            classes = self.vit_classifier.classify(image_path)
-            detected_objects = self.detr_detector.detect(image_path)
-
-            self.root.after(0, self.update_progress_and_canvas, idx, total_images, image_path, image_file, classes + detected_objects)
 
-            if self.trust_ai.get():
-                tags_states = {tag: tk.BooleanVar(value=True) for tag in classes + detected_objects}
-                self.apply_tags(image_file,image_path, tags_states)
+            # Images finished (or failed) in a previous run of the job are skipped
+            if job.is_complete(image_path):
+                self.root.after(0, self.update_progress, idx, total_images)
+            # Images without a journaled prediction go through the models below
+            elif image_path not in job.predictions:
+                pending_paths.append(image_path)
+                continue
+            else:
+                # Predictions made before an interruption are reused without running inference again
+                keywords = job.predictions[image_path]
+                self.root.after(0, self.update_progress_and_canvas, idx, total_images, image_path, image_file, keywords)
+                self._apply_job_tags(job, image_path, keywords)
+            idx += 1
+
+        def skip(image_path, error):
+            # A broken image is journaled as failed so resuming the job doesn't stop on it again
+            nonlocal idx
+            print(f"ERROR: {image_path}: {error}")
+            job.record_failure(image_path, error)
+            self.root.after(0, self.update_progress, idx, total_images)
+            idx += 1
+
+        # Images are decoded and run through the models in batches sized by the tuning profile
+        with closing(self.pipeline.run(pending_paths, on_error=skip)) as results:
+            for image_path, classes, detected_objects in results:
+                keywords = classes + detected_objects
+                job.record_prediction(image_path, keywords)
+
+                self.root.after(0, self.update_progress_and_canvas, idx, total_images, image_path, image_path, keywords)
+                self._apply_job_tags(job, image_path, keywords)
+                idx += 1
+
+                if self.stop_requested:
+                    self.stop_requested = False  
+                    return
+
+        job.finish()
+
+    def _apply_job_tags(self, job, image_path, keywords):
+        """Write the predicted tags when the job trusts the AI, unless a previous run already did."""
+        if job.options["apply_tags"] and image_path not in job.written:
+            tags_states = {tag: tk.BooleanVar(value=True) for tag in keywords}
+            try:
+                self.apply_tags(image_path, image_path, tags_states)
+            except Exception as e:
+                print(f"ERROR: writing tags of {image_path}: {e}")
+                job.record_failure(image_path, e)
+                return
+            job.record_written(image_path)
 
-        self.root.after(0, self.finish_processing)
+    def update_progress(self, idx, total_images):
+        """Update the progress bar."""
+        self.progress_var.set(idx + 1)
+        self.progress_label["text"] = f"{idx + 1}/{total_images}"
 
     def update_progress_and_canvas(self, idx, total_images, image_path, image_file, combined_results):
         """Update the progress bar and add new results to the canvas."""
-        self.progress_var.set(idx + 1)
-        self.progress_label["text"] = f"{idx + 1}/{total_images}"
+        self.update_progress(idx, total_images)
         
-        thumbnail = ImageUtils.generate_thumbnail(image_path)
+        thumbnail = ImageUtils.generate_thumbnail(image_path, memory_budget=self.memory_budget)
         self.all_thumbnails.append(thumbnail)
         self.display_on_canvas(thumbnail, image_file, image_path, combined_results)
 
@@ -466,9 +559,34 @@ class ImageClassifierApp:
 
 
 
-    def display_image_on_canvas(self, image_path):
+    def find_similar(self, image_path):
+        """Search the embedding store for images similar to the given one."""
+        if not image_path:
+            return
+        threading.Thread(target=self._find_similar, args=(image_path,)).start()
+
+    def _find_similar(self, image_path):
+        """Look up or compute the query embedding and run the similarity search."""
+        embedding = self.embedding_store.get(image_path)
+        if embedding is None:
+            embedding = self.vit_classifier.embed(image_path)
+        results = self.embedding_store.search(embedding, k=20, exclude_path=image_path)
+        self.root.after(0, self.show_similar_results, results)
+
+    def show_similar_results(self, results):
+        """Display the images returned by a similarity search on the canvas."""
+        results = [(path, score) for path, score in results if os.path.exists(path)]
+        if not results:
+            self.show_toast(self.translator.translate("no_similar_images"))
+            return
+
+        self.clear_canvas()
+        for path, score in results:
+            self.display_image_on_canvas(path, caption=f"{score:.2f}")
+
+    def display_image_on_canvas(self, image_path, caption=None):
         """Display an image thumbnail on the canvas."""
-        thumbnail_img = ImageUtils.generate_thumbnail(image_path)
+        thumbnail_img = ImageUtils.generate_thumbnail(image_path, memory_budget=self.memory_budget)
         thumbnail = ImageTk.PhotoImage(thumbnail_img)
         
         frame_bg = DARK_COLOR if len(self.canvas_frame.winfo_children()) % 2 == 0 else EVEN_DARKER_COLOR
@@ -485,6 +603,8 @@ class ImageClassifierApp:
         right_frame.pack(side="right", fill="both", expand=True)
 
         tk.Label(right_frame, text=os.path.basename(image_path), bg=frame_bg, fg=TEXT_COLOR).pack(anchor="w")
+        if caption:
+            tk.Label(right_frame, text=caption, bg=frame_bg, fg=TEXT_COLOR).pack(anchor="w")
 
         # main_frame.bind("<Button-1>", lambda event: self.on_list_item_click(image_path, os.path.basename(image_path)))
 
@@ -497,7 +617,7 @@ class ImageClassifierApp:
     
     def show_preview(self, image_path):
         """Show an enlarged preview of the image in the right frame."""
-        larger_thumbnail_img = ImageUtils.generate_thumbnail(image_path, base_size=400)
+        larger_thumbnail_img = ImageUtils.generate_thumbnail(image_path, base_size=400, memory_budget=self.memory_budget)
         larger_thumbnail = ImageTk.PhotoImage(larger_thumbnail_img)
         
         self.preview_image_label.configure(image=larger_thumbnail)